@@ -0,0 +1,200 @@
+"""Headless DPC analysis of many 4D-STEM datasets
+
+Run as ``getdpc-batch`` or ``python -m getdpc.Batch``. Every dataset goes through calibration, CoM shifts,
+PL rotation and the electrostatics of getdpc.GetDPC, the results are written as one .npz file per
+dataset. A manifest in the output directory records finished datasets so an interrupted batch can
+simply be started again.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+import typing
+import numpy as np
+
+from getdpc import Cache, GetDPC, Storage
+
+DEFAULT_CONFIG = {
+    'conv': 32.,          # Convergence angle (mrad)
+    'threshold': 0.3,     # BF disk threshold (fraction of 1)
+    'fit': 'centroid',    # BF disk center from its 'centroid' or a 'circle' fit to its edge
+    'sample': None,       # Calibrate from this number (or fraction) of random scan positions, None for all
+    'stride': None,       # Calibrate from every stride-th scan position, None for all
+    'ri': 0.,             # Inner detector radius (mrad)
+    'ro': None,           # Outer detector radius (mrad), None for 1.1 times the convergence angle
+    'descan': None,       # Order of the polynomial descan correction (1 for a plane), None for none
+    'rotation': 'auto',   # PL rotation in degrees, or 'auto' to find it from the curl
+    'hpass': 0.,          # High-pass filter of the potential
+    'lpass': 0.,          # Low-pass filter of the potential
+    'pad': 'none',        # Edge handling of the potential: 'none', 'mirror' or 'zero'
+    'chunk_rows': None,   # Scan rows read per block, None to size automatically
+    'workers': 1,         # Threads per dataset for the 4D reductions
+    'raw': None,          # For raw files: {'shape': [SY, SX, NY, NX], 'dtype': 'uint16', 'offset': 0}
+    'cache': None,        # Directory of a result cache shared by runs, None for no cache
+}
+
+MANIFEST = 'manifest.json'
+
+
+def LoadConfig(path: typing.Optional[str] = None, **overrides) -> typing.Dict:
+    """Read a JSON configuration and fill in the defaults
+
+    :param path: JSON file with any of the keys of DEFAULT_CONFIG (None for the defaults)
+    :param overrides: Values that replace those of the file
+    :return: complete configuration
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path) as f: loaded = json.load(f)
+        unknown = set(loaded) - set(DEFAULT_CONFIG)
+        if unknown: raise ValueError('Unknown configuration keys: ' + ', '.join(sorted(unknown)))
+        config.update(loaded)
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    if config['ro'] is None: config['ro'] = 1.1 * config['conv']
+    return config
+
+
+def _ConfigHash(config: typing.Dict) -> str:
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def Open4DFile(path: str, config: typing.Dict) -> np.ndarray:
+    """Open a chunked directory, memory-map a .npy file, or a raw file described by the 'raw' entry of the configuration"""
+    if Storage.IsChunked4D(path): return Storage.Chunked4D(path)
+    if path.endswith('.npy'): return np.load(path, mmap_mode='r')
+    raw = config.get('raw')
+    if not raw: raise ValueError(path + ' is not a .npy file and no raw layout is configured')
+    return np.memmap(path, dtype=raw.get('dtype', 'uint16'), mode='r', offset=raw.get('offset', 0), shape=tuple(raw['shape']))
+
+
+def ProcessDataset(path: str, config: typing.Dict, outdir: str) -> typing.Dict:
+    """Run the complete DPC analysis of one 4D Dataset and save the results
+
+    :param path: .npy or raw file, or chunked directory of the 4D Dataset
+    :param config: Complete configuration (see LoadConfig)
+    :param outdir: Directory receiving <name>_dpc.npz
+    :return: summary with calibration, rotation, output file and run time
+    """
+    start = time.perf_counter()
+    dat4d = Open4DFile(path, config)
+    options = {'chunk_rows': config['chunk_rows'], 'workers': config['workers']}
+    # Runs with other rotation or potential settings load the 4D reductions from the cache
+    call = Cache.ResultCache(config['cache']).call if config['cache'] else lambda function, *args, **kwargs: function(*args, **kwargs)
+    R, rcx, rcy, pixcal, BFdisk, absct, edge = call(GetDPC.CalibrateRonchigram, dat4d, config['conv'], config['threshold'], fit=config['fit'], sample=config['sample'], stride=config['stride'], seed=0, **options)
+    descan = None if config['descan'] is None else GetDPC.GetDescanMap(dat4d, order=config['descan'], seed=0)
+    detim, dpcx, dpcy = call(GetDPC.GetVirtualDetectors, dat4d, rcx, rcy, pixcal, [(config['ri'], config['ro'])], descan=descan, **options)[0]
+    if config['rotation'] in (None, 'auto'): rotation = GetDPC.GetPLRotation(dpcx, dpcy)
+    else: rotation = float(config['rotation']) * np.pi / 180
+    rho = GetDPC.GetChargeDensity(dpcx, dpcy, rotation=rotation)
+    EMag, EDir, EDirLeg = GetDPC.GetElectricFields(dpcx, dpcy, rotation=rotation, dtype=np.float32)
+    V = GetDPC.GetPotential(dpcx, dpcy, rotation=rotation, hpass=config['hpass'], lpass=config['lpass'], pad=config['pad'])
+    name = os.path.splitext(os.path.basename(path))[0]
+    output = os.path.join(outdir, name + '_dpc.npz')
+    partial = output + '.part.npz'
+    np.savez(partial, ronchigram=R, bfdisk=BFdisk, detector=detim, dpcx=dpcx, dpcy=dpcy, charge=rho, efield=EMag, edir=EDir, edirlegend=EDirLeg, potential=V,
+             calibration=np.array([rcx, rcy, pixcal]), rotation=np.array(rotation))
+    os.replace(partial, output)
+    return {'output': output, 'rcx': float(rcx), 'rcy': float(rcy), 'pixcal': float(pixcal), 'rotation': float(rotation * 180 / np.pi), 'seconds': time.perf_counter() - start}
+
+
+def FindDatasets(inputs: typing.Sequence[str], extensions: typing.Sequence[str] = ('.npy', '.raw', '.bin', '.dat')) -> typing.List[str]:
+    """Expand directories into the 4D data files and chunked directories they contain"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item) and not Storage.IsChunked4D(item):
+            paths.extend(sorted(os.path.join(item, f) for f in os.listdir(item) if os.path.splitext(f)[1].lower() in extensions or Storage.IsChunked4D(os.path.join(item, f))))
+        else: paths.append(item)
+    return [os.path.abspath(path) for path in paths]
+
+
+def _LoadManifest(outdir: str) -> typing.Dict:
+    try:
+        with open(os.path.join(outdir, MANIFEST)) as f: return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _SaveManifest(outdir: str, manifest: typing.Dict):
+    path = os.path.join(outdir, MANIFEST)
+    with open(path + '.tmp', 'w') as f: json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def RunBatch(inputs: typing.Sequence[str], outdir: str, config: typing.Dict, *, jobs: int = 1, force: bool = False, log: typing.Callable[[str], None] = print) -> typing.Dict:
+    """Process datasets concurrently, skipping those the manifest lists as done with the same configuration
+
+    :param inputs: Files or directories of 4D Datasets
+    :param outdir: Output directory, also holds the manifest
+    :param config: Complete configuration (see LoadConfig)
+    :param jobs: Number of datasets processed at the same time in separate processes
+    :param force: Process all datasets even if they are finished
+    :param log: Receives one line per started, finished or failed dataset
+    :return: the updated manifest
+    """
+    os.makedirs(outdir, exist_ok=True)
+    manifest = _LoadManifest(outdir)
+    confighash = _ConfigHash(config)
+
+    def Signature(path):
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'config': confighash}
+
+    todo = []
+    for path in FindDatasets(inputs):
+        entry = manifest.get(path)
+        if not force and entry is not None and entry.get('status') == 'done' and entry.get('signature') == Signature(path) and os.path.exists(entry.get('output', '')):
+            log('Skipping ' + path + ' (done)')
+            continue
+        todo.append(path)
+
+    def Finished(path, summary=None, error=None):
+        entry = {'signature': Signature(path)}
+        if error is None: entry.update(status='done', **summary)
+        else: entry.update(status='failed', error=error)
+        manifest[path] = entry
+        _SaveManifest(outdir, manifest)
+        log(('Finished ' if error is None else 'Failed ') + path + ('' if error is None else ': ' + error.strip().splitlines()[-1]))
+
+    if jobs <= 1:
+        for path in todo:
+            log('Processing ' + path)
+            try:
+                Finished(path, ProcessDataset(path, config, outdir))
+            except Exception:
+                Finished(path, error=traceback.format_exc())
+        return manifest
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {pool.submit(ProcessDataset, path, config, outdir): path for path in todo}
+        for path in todo: log('Queued ' + path)
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                Finished(path, future.result())
+            except Exception:
+                Finished(path, error=traceback.format_exc())
+    return manifest
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='getdpc-batch', description='DPC analysis of 4D-STEM datasets without Nion Swift')
+    parser.add_argument('inputs', nargs='+', help='.npy or raw 4D-STEM files, or directories containing them')
+    parser.add_argument('-o', '--output', default='getdpc_output', help='output directory (default: getdpc_output)')
+    parser.add_argument('-c', '--config', help='JSON configuration, see getdpc.Batch.DEFAULT_CONFIG')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='datasets processed at the same time')
+    parser.add_argument('--conv', type=float, help='convergence angle (mrad)')
+    parser.add_argument('--rotation', help="PL rotation in degrees or 'auto'")
+    parser.add_argument('--force', action='store_true', help='also process datasets the manifest lists as done')
+    args = parser.parse_args(argv)
+
+    config = LoadConfig(args.config, conv=args.conv, rotation=args.rotation)
+    manifest = RunBatch(args.inputs, args.output, config, jobs=args.jobs, force=args.force)
+    failed = [path for path, entry in manifest.items() if entry.get('status') == 'failed']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""Benchmarks of the GetDPC functions on synthetic 4D-STEM data
+
+Run as ``python -m getdpc.Benchmark`` to time and memory-profile every step of a DPC analysis, write
+the results as JSON and compare them against a stored baseline. With ``--imports`` the import time of
+the modules loaded at Nion Swift startup is measured as well, and loading scipy or matplotlib counts
+as a regression.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import typing
+import numpy as np
+
+from getdpc import GetDPC
+
+
+def SyntheticRonchigrams(scan: typing.Tuple[int, int] = (64, 64), detector: typing.Tuple[int, int] = (64, 64), *, dtype: np.dtype = np.uint16, radius: float = 0.25, shift: float = 2, counts: float = 1000, noise: bool = True, seed: typing.Optional[int] = 0) -> np.ndarray:
+    """Simulate a 4D Dataset of Ronchigrams whose BF disk is shifted by a smooth field of atomic columns
+
+    :param scan: Number of scan positions (Y, X)
+    :param detector: Number of Ronchigram pixels (Y, X)
+    :param dtype: Type of the simulated data
+    :param radius: Radius of the BF disk as fraction of the Ronchigram width
+    :param shift: Largest shift of the BF disk (pixels)
+    :param counts: Mean intensity inside the BF disk
+    :param noise: Add Poisson noise (bool)
+    :param seed: Seed of the random columns and noise
+    :return: 4D Dataset as ndarray
+    """
+    rng = np.random.default_rng(seed)
+    SY, SX = scan
+    NY, NX = detector
+    # Gaussian columns on a jittered lattice, the disk shifts along the gradient of their sum
+    yy, xx = np.mgrid[0:SY, 0:SX].astype(float)
+    V = np.zeros(scan)
+    for cy in np.arange(4, SY, 8):
+        for cx in np.arange(4, SX, 8):
+            V += np.exp(-((xx - cx - rng.normal(0, 0.5)) ** 2 + (yy - cy - rng.normal(0, 0.5)) ** 2) / 4)
+    gy, gx = np.gradient(V)
+    scale = shift / max(np.amax(np.hypot(gx, gy)), 1e-12)
+    dx, dy = gx * scale, gy * scale
+    ky, kx = np.mgrid[0:NY, 0:NX].astype(float)
+    r2 = (radius * NX) ** 2
+    dat4d = np.empty(scan + detector, dtype=dtype)
+    for i in range(SY):
+        R = counts * (((kx - NX / 2 - dx[i, :, None, None]) ** 2 + (ky - NY / 2 - dy[i, :, None, None]) ** 2) < r2)
+        if noise: R = rng.poisson(R + counts / 100)
+        dat4d[i] = R
+    return dat4d
+
+
+# Modules loaded by the Nion Swift plugin at startup, and modules they must only import when used
+STARTUP_MODULES = ('getdpc.GetDPC', 'getdpc.Pipeline', 'getdpc.Cache')
+HEAVY_MODULES = ('scipy', 'matplotlib')
+
+
+def MeasureImport(module: str, *, repeat: int = 3) -> typing.Dict:
+    """Time to import a module in a fresh interpreter that already has numpy loaded, as Nion Swift has
+
+    :param module: Name of the module
+    :param repeat: Number of fresh interpreters, the best time is reported
+    :return: import time and the heavy modules loaded by the import
+    """
+    code = ('import json, sys, time, numpy\nstart = time.perf_counter()\nimport ' + module + '\n'
+            'print(json.dumps([time.perf_counter() - start, [m for m in ' + repr(HEAVY_MODULES) + ' if m in sys.modules]]))')
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = root + os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else root
+    times, heavy = [], []
+    for i in range(repeat):
+        seconds, heavy = json.loads(subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout.splitlines()[-1])
+        times.append(seconds)
+    return {'time': min(times), 'heavy': heavy}
+
+
+def _Measure(function: typing.Callable, repeat: int) -> typing.Dict[str, float]:
+    """Best wall time over repeat calls, then peak traced allocation of one more call"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'time': min(times), 'mean_time': float(np.mean(times)), 'peak_mb': peak / 1024 ** 2}
+
+
+def RunBenchmarks(scan: typing.Tuple[int, int] = (64, 64), detector: typing.Tuple[int, int] = (64, 64), *, dtype: np.dtype = np.uint16, accum: np.dtype = np.float32, conv: float = 32, repeat: int = 3, functions: typing.Optional[typing.Sequence[str]] = None, imports: bool = False) -> typing.Dict:
+    """Time and memory-profile the GetDPC functions on a synthetic 4D Dataset
+
+    :param scan: Number of scan positions (Y, X)
+    :param detector: Number of Ronchigram pixels (Y, X)
+    :param dtype: Type of the simulated data
+    :param accum: Precision of the 4D reductions (np.float32 or np.float64)
+    :param conv: Convergence Angle of Electron Probe in mrad
+    :param repeat: Number of timed calls per function, the best is reported
+    :param functions: Names of the functions to benchmark (default: all)
+    :param imports: Also measure the import time of STARTUP_MODULES (bool)
+    :return: machine-readable results with the benchmark setup and one entry per function (and per module)
+
+    The throughput of the 4D reductions is the size of the raw data read per second, so it can be
+    compared directly with the memory or disk bandwidth.
+    """
+    dat4d = SyntheticRonchigrams(scan, detector, dtype=dtype)
+    R, rcx, rcy, pixcal, BFdisk, absct, edge = GetDPC.CalibrateRonchigram(dat4d, conv)
+    dpcx, dpcy = GetDPC.GetiCoM(dat4d, rcx, rcy, pixcal, 0, conv)
+    rotation = GetDPC.GetPLRotation(dpcx, dpcy)
+    cases = {
+        'CalibrateRonchigram': (lambda: GetDPC.CalibrateRonchigram(dat4d, conv, accum=accum), dat4d.nbytes),
+        'GetDetectorImage': (lambda: GetDPC.GetDetectorImage(dat4d, rcx, rcy, pixcal, 0, conv, accum=accum), dat4d.nbytes),
+        'GetiCoM': (lambda: GetDPC.GetiCoM(dat4d, rcx, rcy, pixcal, 0, conv, accum=accum), dat4d.nbytes),
+        'GetDiskShifts': (lambda: GetDPC.GetDiskShifts(dat4d, BFdisk, pixcal, accum=accum), dat4d.nbytes),
+        'GetPLRotation': (lambda: GetDPC.GetPLRotation(dpcx, dpcy), 2 * dpcx.nbytes),
+        'GetElectricFields': (lambda: GetDPC.GetElectricFields(dpcx, dpcy, rotation=rotation), 2 * dpcx.nbytes),
+        'GetChargeDensity': (lambda: GetDPC.GetChargeDensity(dpcx, dpcy, rotation=rotation), 2 * dpcx.nbytes),
+        'GetPotential': (lambda: GetDPC.GetPotential(dpcx, dpcy, rotation=rotation, hpass=0.005), 2 * dpcx.nbytes),
+    }
+    results = {}
+    for name, (function, nbytes) in cases.items():
+        if functions is not None and name not in functions: continue
+        result = _Measure(function, repeat)
+        result['throughput_mb_s'] = nbytes / 1024 ** 2 / max(result['time'], 1e-12)
+        results[name] = result
+    benchmark = {
+        'setup': {'scan': list(scan), 'detector': list(detector), 'dtype': np.dtype(dtype).name, 'accum': np.dtype(accum).name, 'conv': conv, 'repeat': repeat},
+        'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'system': platform.system()},
+        'results': results,
+    }
+    if imports: benchmark['imports'] = {module: MeasureImport(module, repeat=repeat) for module in STARTUP_MODULES}
+    return benchmark
+
+
+def CompareToBaseline(current: typing.Dict, baseline: typing.Dict, *, tolerance: float = 0.25) -> typing.List[str]:
+    """Find functions that became slower or use more memory than in a stored baseline, and startup modules that import heavy modules or became slower to import
+
+    :param current: Results of RunBenchmarks
+    :param baseline: Earlier results of RunBenchmarks with the same setup
+    :param tolerance: Allowed relative increase of time and peak memory
+    :return: one message per regression (empty if there are none)
+    """
+    regressions = []
+    for module, result in current.get('imports', {}).items():
+        if result['heavy']: regressions.append('import ' + module + ' loads ' + ', '.join(result['heavy']))
+        reference = baseline.get('imports', {}).get(module)
+        # Import times are short and noisy, so a few milliseconds more are not reported
+        if reference is not None and result['time'] > reference['time'] * (1 + tolerance) and result['time'] - reference['time'] > 0.02:
+            regressions.append('import ' + module + ' time: ' + format(result['time'], '.4g') + ' vs baseline ' + format(reference['time'], '.4g'))
+    if current.get('setup') != baseline.get('setup'):
+        regressions.append('Benchmark setup differs from the baseline: ' + json.dumps(baseline.get('setup')))
+        return regressions
+    for name, result in current['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None: continue
+        for key in ('time', 'peak_mb'):
+            if result[key] > reference[key] * (1 + tolerance) and result[key] - reference[key] > 1e-3:
+                regressions.append(name + ' ' + key + ': ' + format(result[key], '.4g') + ' vs baseline ' + format(reference[key], '.4g'))
+    return regressions
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m getdpc.Benchmark', description='Benchmark GetDPC on synthetic 4D-STEM data')
+    parser.add_argument('--scan', type=int, nargs=2, default=[64, 64], metavar=('SY', 'SX'), help='number of scan positions')
+    parser.add_argument('--detector', type=int, nargs=2, default=[64, 64], metavar=('NY', 'NX'), help='number of Ronchigram pixels')
+    parser.add_argument('--dtype', default='uint16', help='type of the simulated data')
+    parser.add_argument('--accum', default='float32', help='precision of the 4D reductions (float32 or float64)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per function')
+    parser.add_argument('--only', nargs='+', metavar='FUNCTION', help='benchmark only these functions')
+    parser.add_argument('--imports', action='store_true', help='also measure the import time of the modules loaded at Nion Swift startup')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results stored in this JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    results = RunBenchmarks(tuple(args.scan), tuple(args.detector), dtype=np.dtype(args.dtype), accum=np.dtype(args.accum), repeat=args.repeat, functions=args.only, imports=args.imports)
+    for name, result in results['results'].items():
+        print(format(name, '20s') + format(result['time'] * 1000, '10.2f') + ' ms' + format(result['peak_mb'], '10.1f') + ' MB' + format(result['throughput_mb_s'], '10.1f') + ' MB/s')
+    for module, result in results.get('imports', {}).items():
+        print(format('import ' + module, '30s') + format(result['time'] * 1000, '10.2f') + ' ms' + ('  loads ' + ', '.join(result['heavy']) if result['heavy'] else ''))
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(results, f, indent=2)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f: json.dump(results, f, indent=2)
+        print('Saved baseline to ' + args.baseline)
+    elif args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = CompareToBaseline(results, baseline, tolerance=args.tolerance)
+        for regression in regressions: print('Regression: ' + regression)
+        if regressions: return 1
+        print('No regressions against ' + args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
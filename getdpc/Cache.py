@@ -0,0 +1,179 @@
+"""Persistent cache of GetDPC results
+
+Results of the 4D reductions are stored on disk under a key made of a fingerprint of the 4D Dataset
+and the function and parameters that produced them, so reopening a dataset loads its mean Ronchigram,
+calibration, CoM shifts and detector images instead of reading the data again. The fingerprint only
+reads a few Ronchigrams spread over the scan, and the least recently used entries are removed once
+the cache grows beyond its size limit.
+"""
+import hashlib
+import json
+import os
+import threading
+import typing
+import zipfile
+import numpy as np
+
+from getdpc import GetDPC
+
+DEFAULT_PATH = os.environ.get('GETDPC_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'getdpc'))
+
+# Keywords that change how a result is computed but not the result itself
+IGNORED = ('progress', 'executor', 'workers', 'chunk_rows')
+
+
+def Fingerprint(dat4d: GetDPC.Dataset4D, *, samples: int = 16) -> str:
+    """Cheap identity of a 4D Dataset from its shape, type and a few Ronchigrams spread over the scan
+
+    :param dat4d: 4D Dataset (ndarray, memmap, Chunked4D or path to .npy or chunked directory), or 5D series as array
+    :param samples: Number of Ronchigrams hashed
+    :return: hexadecimal digest
+    """
+    dat4d = GetDPC._Open4D(dat4d)
+    digest = hashlib.sha1(json.dumps([list(dat4d.shape), np.dtype(dat4d.dtype).str]).encode())
+    positions = int(np.prod(dat4d.shape[:-2]))
+    for i in np.unique(np.linspace(0, positions - 1, min(samples, positions)).astype(int)):
+        digest.update(np.ascontiguousarray(dat4d[np.unravel_index(i, dat4d.shape[:-2])]).tobytes())
+    return digest.hexdigest()
+
+
+def _Canonical(value) -> typing.Any:
+    """JSON-serializable form of a parameter, arrays and objects are reduced to a hash of their content"""
+    if value is None or isinstance(value, (bool, int, float, str)): return value
+    if isinstance(value, np.generic): return value.item()
+    if isinstance(value, np.dtype) or (isinstance(value, type) and issubclass(value, np.generic)): return np.dtype(value).str
+    if isinstance(value, np.ndarray):
+        return ['ndarray', list(value.shape), value.dtype.str, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()]
+    if isinstance(value, (list, tuple)): return [_Canonical(item) for item in value]
+    if isinstance(value, dict): return {str(key): _Canonical(item) for key, item in value.items()}
+    if hasattr(value, '__dict__'):
+        return [type(value).__qualname__, {key: _Canonical(item) for key, item in vars(value).items() if not key.startswith('_')}]
+    raise TypeError(type(value).__name__ + ' parameters cannot be cached')
+
+
+def _Flatten(value, arrays: typing.List[np.ndarray]) -> typing.Dict:
+    """Describe a result as JSON, the arrays it contains are appended to arrays"""
+    if isinstance(value, (np.ndarray, np.generic)):
+        arrays.append(np.asarray(value))
+        return {'array' if isinstance(value, np.ndarray) else 'scalar': len(arrays) - 1}
+    if isinstance(value, (tuple, list)): return {type(value).__name__: [_Flatten(item, arrays) for item in value]}
+    if isinstance(value, dict): return {'dict': [[key, _Flatten(item, arrays)] for key, item in value.items()]}
+    if value is None or isinstance(value, (bool, int, float, str)): return {'value': value}
+    raise TypeError(type(value).__name__ + ' results cannot be cached')
+
+
+def _Unflatten(structure: typing.Dict, arrays: typing.Mapping[str, np.ndarray]):
+    kind, value = next(iter(structure.items()))
+    if kind == 'array': return arrays['a' + str(value)]
+    if kind == 'scalar': return arrays['a' + str(value)][()]
+    if kind == 'tuple': return tuple(_Unflatten(item, arrays) for item in value)
+    if kind == 'list': return [_Unflatten(item, arrays) for item in value]
+    if kind == 'dict': return {key: _Unflatten(item, arrays) for key, item in value}
+    return value
+
+
+class ResultCache:
+    """Size-bounded store of results on disk, one .npz file per result
+
+    Entries are written atomically and their modification time is updated on every hit, so several
+    sessions or processes can share one cache directory and eviction removes the least recently used.
+
+    :param path: Cache directory, created if needed (default: $GETDPC_CACHE or ~/.cache/getdpc)
+    :param max_bytes: Size above which the least recently used entries are removed
+    """
+
+    def __init__(self, path: typing.Optional[typing.Union[str, os.PathLike]] = None, *, max_bytes: int = 2 * 1024 ** 3):
+        self.path = os.fspath(path if path is not None else DEFAULT_PATH)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return 'ResultCache(' + repr(self.path) + ', ' + str(len(self.entries())) + ' entries, ' + format(self.size / 1024 ** 2, '.1f') + ' MB)'
+
+    def key(self, fingerprint: str, name: str, *args, **kwargs) -> str:
+        """Key of the result of name(dat4d, *args, **kwargs) for the 4D Dataset with the given fingerprint"""
+        params = {key: value for key, value in kwargs.items() if key not in IGNORED}
+        return hashlib.sha1(json.dumps([fingerprint, name, _Canonical(args), _Canonical(params)], sort_keys=True).encode()).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key + '.npz')
+
+    def load(self, key: str) -> typing.Tuple[bool, typing.Any]:
+        """(True, result) for a stored key, (False, None) otherwise, unreadable entries are removed"""
+        try:
+            with np.load(self._file(key), allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            result = _Unflatten(json.loads(str(arrays.pop('structure'))), arrays)
+            os.utime(self._file(key))
+        except FileNotFoundError:
+            self.misses += 1
+            return False, None
+        except (zipfile.BadZipFile, EOFError, KeyError, IndexError, StopIteration, ValueError, OSError):
+            # Truncated or otherwise corrupt entries, e.g. from a full disk, are computed and stored again
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, result
+
+    def store(self, key: str, result):
+        """Write a result (arrays, scalars and tuples, lists or dicts of them) and evict old entries"""
+        arrays = []
+        structure = _Flatten(result, arrays)
+        partial = self._file(key) + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.part.npz'
+        np.savez(partial, structure=np.array(json.dumps(structure)), **{'a' + str(i): array for i, array in enumerate(arrays)})
+        os.replace(partial, self._file(key))
+        self.evict()
+
+    def call(self, function: typing.Callable, dat4d: GetDPC.Dataset4D, *args, **kwargs):
+        """function(dat4d, *args, **kwargs), loaded from the cache if it was computed before"""
+        key = self.key(Fingerprint(dat4d), function.__module__ + '.' + function.__qualname__, *args, **kwargs)
+        found, result = self.load(key)
+        if found: return result
+        result = function(dat4d, *args, **kwargs)
+        self.store(key, result)
+        return result
+
+    def entries(self) -> typing.List[typing.Tuple[str, int, float]]:
+        """(file, size, last use) of every entry, least recently used first"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npz') or name.endswith('.part.npz'): continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((name, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    @property
+    def size(self) -> int:
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, max_bytes: typing.Optional[int] = None) -> int:
+        """Remove the least recently used entries until the cache fits into max_bytes
+
+        :return: number of removed entries
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for name, size, used in entries:
+            if total <= limit: break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self) -> int:
+        """Remove all entries"""
+        return self.evict(0)
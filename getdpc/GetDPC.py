@@ -1,158 +1,1408 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
 import typing
 import numpy as np
-from matplotlib.colors import hsv_to_rgb
+# scipy.fft is imported by the functions using it, so importing GetDPC (and the Nion Swift plugin) only needs numpy
 
+# Target size of a block of scan rows expanded to float64 when chunk_rows is not given
+CHUNK_BYTES = 64 * 1024 ** 2
+
+Dataset4D = typing.Union[np.ndarray, str, os.PathLike]
+# Series of 4D Datasets: 5D array or memmap (time first), path to a 5D .npy file, or sequence of 4D Datasets
+Dataset5D = typing.Union[np.ndarray, str, os.PathLike, typing.Sequence[Dataset4D]]
+ProgressCallback = typing.Callable[[int, int], None]
+# (Inner, Outer) radii in mrad, optionally followed by (Start, End) angles in radians for a segment
+DetectorSpec = typing.Tuple[float, ...]
+
+_log = logging.getLogger('getdpc')
+
+
+def _Open4D(dat4d: Dataset4D) -> np.ndarray:
+    """Memory-map a 4D Dataset given as a path to a .npy file, open a path to a chunked directory, pass arrays through unchanged"""
+    if isinstance(dat4d, (str, os.PathLike)):
+        if os.path.isdir(dat4d):
+            from getdpc import Storage
+            return Storage.Chunked4D(dat4d)
+        return np.load(dat4d, mmap_mode='r')
+    return dat4d
+
+
+def _ChunkRows(shape: typing.Tuple[int, ...], chunk_rows: typing.Optional[int] = None) -> int:
+    """Number of scan rows per block, sized so a block stays near CHUNK_BYTES when not given"""
+    if chunk_rows is not None: return max(1, int(chunk_rows))
+    rowbytes = 8 * int(np.prod(shape[1:]))
+    return int(min(shape[0], max(1, CHUNK_BYTES // rowbytes)))
+
+
+def GetPeakMemory() -> typing.Optional[float]:
+    """Peak resident memory of the current process
+
+    :return: peak resident set size in MB (None if the platform does not report it)
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / 1024 ** 2
+    return None
+
+
+class Report:
+    """Per-stage measurements collected while Instrument is active
+
+    Every call of an instrumented GetDPC function is one stage with its wall time, the bytes and
+    Ronchigrams read from the 4D Dataset, the resulting throughput and, with memory, the peak of
+    traced allocations. Calls made from another instrumented function have a depth above 0 and
+    their reads are included in the caller's stage as well. Stages are listed in the order they
+    started and get their measurements when they finish.
+    """
+
+    def __init__(self, memory: bool = False, log: bool = True):
+        self.memory = memory
+        self.log = log
+        self.stages = []
+
+    def finished(self) -> typing.List[typing.Dict]:
+        """Stages that have completed, in the order they started"""
+        return [stage for stage in self.stages if 'seconds' in stage]
+
+    def totals(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """Calls, time and bytes read summed by stage name"""
+        totals = collections.OrderedDict()
+        for stage in self.finished():
+            total = totals.setdefault(stage['stage'], {'calls': 0, 'seconds': 0., 'bytes_read': 0, 'frames': 0})
+            total['calls'] += 1
+            for key in ('seconds', 'bytes_read', 'frames'): total[key] += stage[key]
+        return totals
+
+    def as_dict(self) -> typing.Dict:
+        return {'stages': self.finished(), 'totals': self.totals(), 'peak_rss_mb': GetPeakMemory()}
+
+    def summary(self) -> str:
+        lines = []
+        for stage in self.finished():
+            line = '  ' * stage['depth'] + stage['stage'] + ': ' + format(stage['seconds'] * 1000, '.1f') + ' ms'
+            if stage['bytes_read']: line += ', ' + format(stage['bytes_read'] / 1024 ** 2, '.1f') + ' MB read, ' + format(stage['mb_per_s'], '.1f') + ' MB/s, ' + format(stage['frames_per_s'], '.0f') + ' frames/s'
+            if stage.get('peak_mb') is not None: line += ', peak ' + format(stage['peak_mb'], '.1f') + ' MB'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+_REPORTS = []
+_STAGES = threading.local()
+
+
+@contextlib.contextmanager
+def Instrument(*, memory: bool = False, log: bool = True) -> typing.Iterator[Report]:
+    """Measure every instrumented GetDPC call made inside the with block
+
+    :param memory: Trace allocations to report the peak memory of every outermost stage (slows NumPy-light code down)
+    :param log: Log every stage at INFO level to the 'getdpc' logger
+    :return: Report that fills up as the stages run
+    """
+    report = Report(memory, log)
+    started = memory and not tracemalloc.is_tracing()
+    if started: tracemalloc.start()
+    _REPORTS.append(report)
+    try:
+        yield report
+    finally:
+        _REPORTS.remove(report)
+        if started: tracemalloc.stop()
+
+
+def _CountRead(frames: int, nbytes: int):
+    """Add Ronchigrams read from a 4D Dataset to the running stage of this thread"""
+    stack = getattr(_STAGES, 'stack', None)
+    if stack:
+        stack[-1]['frames'] += int(frames)
+        stack[-1]['bytes_read'] += int(nbytes)
+
+
+def _Instrumented(function: typing.Callable) -> typing.Callable:
+    """Record calls of function as stages of the active Reports, costs a single check when none is active"""
+    name = function.__qualname__ if function.__module__ == __name__ else function.__module__.split('.')[-1] + '.' + function.__qualname__
+
+    @functools.wraps(function)
+    def Stage(*args, **kwargs):
+        if not _REPORTS: return function(*args, **kwargs)
+        if not hasattr(_STAGES, 'stack'): _STAGES.stack = []
+        stack = _STAGES.stack
+        stage = {'stage': name, 'depth': len(stack), 'bytes_read': 0, 'frames': 0}
+        # Only outermost stages reset the allocation peak, nested ones would spoil it
+        memory = not stack and tracemalloc.is_tracing() and any(report.memory for report in _REPORTS)
+        if memory:
+            if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        # Stages are listed when they start, so nested calls follow the stage that made them
+        for report in list(_REPORTS): report.stages.append(stage)
+        stack.append(stage)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1]['frames'] += stage['frames']
+                stack[-1]['bytes_read'] += stage['bytes_read']
+            stage['seconds'] = seconds
+            stage['frames_per_s'] = stage['frames'] / max(seconds, 1e-12)
+            stage['mb_per_s'] = stage['bytes_read'] / 1024 ** 2 / max(seconds, 1e-12)
+            stage['peak_mb'] = (tracemalloc.get_traced_memory()[1] - before) / 1024 ** 2 if memory else None
+            if any(report.log for report in _REPORTS):
+                _log.info('%s%s: %.1f ms, %.1f MB read, %.0f frames/s', '  ' * stage['depth'], name, seconds * 1000, stage['bytes_read'] / 1024 ** 2, stage['frames_per_s'])
+    return Stage
+
+
+def _MemmapOffset(array: np.ndarray) -> typing.Optional[int]:
+    """Byte offset in its file of the first element of a memmap or a view of one, None if it is not backed by a file
+
+    Views of a memmap copy the offset of the array they were taken from, so the offset is found from the
+    distance of the view's first element to the start of the array that owns the mapping.
+    """
+    if not isinstance(array, np.memmap) or array.filename is None: return None
+    root = array
+    while isinstance(root.base, np.ndarray): root = root.base
+    if not isinstance(root, np.memmap): return None
+    return root.offset + array.__array_interface__['data'][0] - root.__array_interface__['data'][0]
 
-def CalibrateRonchigram(dat4d: np.ndarray, conv: float = 32, t: float = 0.3) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, float, float, np.ndarray, np.ndarray]:
-    """Find true center of Ronchigram, and pixels/mrad calibration
+
+def _SharedSource(dat4d: np.ndarray, stack: contextlib.ExitStack) -> typing.Tuple:
+    """Describe a 4D Dataset so worker processes can open it without pickling the data
+
+    Memory-mapped files and chunked directories are reopened by every worker, in-memory arrays are copied once into a
+    shared memory block that lives as long as the stack (Python 3.8 or later).
+    """
+    offset = _MemmapOffset(dat4d)
+    if offset is not None and dat4d.flags.c_contiguous:
+        return 'file', dat4d.filename, offset, dat4d.dtype.str, dat4d.shape
+    if hasattr(dat4d, 'chunk_rows') and hasattr(dat4d, 'path'):
+        return 'chunked', dat4d.path, 0, dat4d.dtype.str, dat4d.shape
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("executor='processes' needs Python 3.8 or later for in-memory data, use executor='threads' or a memmap") from None
+    shm = shared_memory.SharedMemory(create=True, size=max(1, dat4d.nbytes))
+    stack.callback(shm.unlink)
+    stack.callback(shm.close)
+    np.ndarray(dat4d.shape, dat4d.dtype, buffer=shm.buf)[...] = dat4d
+    return 'shm', shm.name, 0, dat4d.dtype.str, dat4d.shape
+
+
+def _ProcessRowBlock(source: typing.Tuple, r0: int, r1: int, kernel: typing.Callable, args: typing.Tuple):
+    """Open the shared 4D Dataset inside a worker process and apply kernel to rows r0:r1"""
+    kind, name, offset, dtype, shape = source
+    if kind == 'file': return kernel(np.asarray(np.memmap(name, dtype, 'r', offset, shape)[r0:r1]), *args)
+    if kind == 'chunked':
+        from getdpc import Storage
+        return kernel(Storage.Chunked4D(name, workers=1)[r0:r1], *args)
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return kernel(np.ndarray(shape, dtype, buffer=shm.buf)[r0:r1].copy(), *args)
+    finally:
+        shm.close()
+
+
+def _MapRowBlocks(dat4d: np.ndarray, kernel: typing.Callable, args: typing.Tuple = (), chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> typing.List:
+    """Apply kernel to consecutive blocks of scan rows, optionally in parallel
+
+    NumPy releases the GIL inside the reductions, so a thread pool is the default. The process
+    pool is a fallback for kernels that hold the GIL; workers then open the data themselves.
+    An exception raised by progress stops the reduction, which is how callers cancel it.
 
     :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions
-    :param conv: Convergence Angle of Electron Probe in mrad
-    :param t: Threshhold for BF Disk (fraction of 1)
-    :return: center, calibrations
+    :param kernel: Module level function called as kernel(block, *args)
+    :param args: Extra arguments passed to kernel
+    :param chunk_rows: Number of scan rows per block (default: sized automatically)
+    :param workers: Number of parallel workers (None for all cores)
+    :param executor: 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block
+    :return: kernel results in scan row order
+    """
+    SY = dat4d.shape[0]
+    # Chunked storage is read in its own blocks, so no block is decompressed twice
+    if chunk_rows is None: chunk_rows = getattr(dat4d, 'chunk_rows', None)
+    chunk_rows = _ChunkRows(dat4d.shape, chunk_rows)
+    starts = range(0, SY, chunk_rows)
+    if workers is None: workers = os.cpu_count() or 1
+    workers = min(workers, len(starts))
+    results = []
+    framebytes = int(np.prod(dat4d.shape[2:])) * dat4d.dtype.itemsize
+
+    def Done(r0):
+        frames = (min(r0 + chunk_rows, SY) - r0) * dat4d.shape[1]
+        _CountRead(frames, frames * framebytes)
+        if progress is not None: progress(len(results), len(starts))
+
+    if workers <= 1:
+        for r0 in starts:
+            results.append(kernel(np.asarray(dat4d[r0:r0 + chunk_rows]), *args))
+            Done(r0)
+        return results
+    if executor not in ('threads', 'processes'): raise ValueError('Unknown executor ' + repr(executor))
+    with contextlib.ExitStack() as stack:
+        if executor == 'threads':
+            pool = stack.enter_context(concurrent.futures.ThreadPoolExecutor(workers))
+            futures = [pool.submit(lambda r0: kernel(np.asarray(dat4d[r0:r0 + chunk_rows]), *args), r0) for r0 in starts]
+        else:
+            source = _SharedSource(dat4d, stack)
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(workers))
+            futures = [pool.submit(_ProcessRowBlock, source, r0, r0 + chunk_rows, kernel, args) for r0 in starts]
+        try:
+            for r0, future in zip(starts, futures):
+                results.append(future.result())
+                Done(r0)
+        except BaseException:
+            for future in futures: future.cancel()
+            raise
+    return results
+
+
+def _SumRowBlock(block: np.ndarray, accum: np.dtype = np.float64) -> np.ndarray:
+    return np.sum(block, axis=(0, 1), dtype=accum)
+
+
+def _SamplePositions(shape: typing.Tuple[int, ...], sample: typing.Optional[float] = None, stride: typing.Union[None, int, typing.Tuple[int, int]] = None, seed: typing.Optional[int] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Scan positions of a strided grid and/or a random subset, sorted so they are read row by row
+
+    :param sample: Number of random positions, or fraction of all positions if below 1
+    :param stride: Step between positions along both scan axes, or (Y, X) steps
+    :return: row and column indices
     """
-    R = np.average(dat4d, axis=(0, 1))
+    SY, SX = shape[:2]
+    sy, sx = (1, 1) if stride is None else (stride, stride) if np.isscalar(stride) else stride
+    rows, cols = np.meshgrid(np.arange(0, SY, sy), np.arange(0, SX, sx), indexing='ij')
+    flat = np.ravel_multi_index((rows.ravel(), cols.ravel()), (SY, SX))
+    if sample is not None:
+        n = int(round(sample * flat.size)) if sample < 1 else int(sample)
+        flat = np.sort(np.random.default_rng(seed).choice(flat, min(max(n, 1), flat.size), replace=False))
+    return np.unravel_index(flat, (SY, SX))
+
+
+def _GroupSums(dat4d: np.ndarray, groups: int, sample: typing.Optional[float], stride: typing.Union[None, int, typing.Tuple[int, int]], seed: typing.Optional[int], accum: np.dtype, chunk_rows: typing.Optional[int], workers: typing.Optional[int], executor: str, progress: typing.Optional[ProgressCallback]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Sums of the Ronchigrams split into groups, and the number of Ronchigrams in every group
+
+    Without sample or stride every block of scan rows is summed by _MapRowBlocks and the blocks
+    are dealt out to the groups in turn, chunked storage provides the mean Ronchigram directly. With them only the selected Ronchigrams are read, one
+    scan row at a time, and dealt out to the groups in turn.
+    """
+    NY, NX = dat4d.shape[2:]
+    sums, counts = np.zeros((groups, NY, NX)), np.zeros(groups)
+    if sample is None and stride is None and groups == 1 and hasattr(dat4d, 'mean_ronchigram'):
+        counts[0] = dat4d.shape[0] * dat4d.shape[1]
+        sums[0] = dat4d.mean_ronchigram * counts[0]
+        return sums, counts
+    if sample is None and stride is None:
+        SX = dat4d.shape[1]
+        rows = _ChunkRows(dat4d.shape, chunk_rows)
+        if groups > 1: rows = min(rows, max(1, dat4d.shape[0] // groups))
+        for i, block in enumerate(_MapRowBlocks(dat4d, _SumRowBlock, (np.dtype(accum),), rows, workers, executor, progress)):
+            sums[i % groups] += block
+            counts[i % groups] += min(rows, dat4d.shape[0] - i * rows) * SX
+        return sums, counts
+    rows, cols = _SamplePositions(dat4d.shape, sample, stride, seed)
+    order = np.arange(rows.size) % groups
+    unique, first = np.unique(rows, return_index=True)
+    bounds = list(first) + [rows.size]
+    for i, row in enumerate(unique):
+        i0, i1 = bounds[i], bounds[i + 1]
+        frames = np.asarray(dat4d[row, cols[i0:i1]], dtype=accum)
+        _CountRead(i1 - i0, (i1 - i0) * NY * NX * dat4d.dtype.itemsize)
+        for g in range(groups):
+            picked = frames[order[i0:i1] == g]
+            sums[g] += np.sum(picked, axis=0, dtype=accum)
+            counts[g] += len(picked)
+        if progress is not None: progress(i + 1, len(unique))
+    return sums, counts
+
+
+@_Instrumented
+def GetMeanRonchigram(dat4d: Dataset4D, *, sample: typing.Optional[float] = None, stride: typing.Union[None, int, typing.Tuple[int, int]] = None, seed: typing.Optional[int] = None, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> np.ndarray:
+    """Average Ronchigram of the 4D Dataset, read sequentially a few scan rows at a time
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param sample: Average only this number of random scan positions (or fraction of them if below 1)
+    :param stride: Average only every stride-th scan position along both axes, or (Y, X) steps
+    :param seed: Seed of the random sample
+    :param dtype: Type of the mean Ronchigram
+    :param accum: Precision of the sums within a block (np.float32 or np.float64), blocks are combined in float64
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: mean Ronchigram as 2D ndarray
+    """
+    dat4d = _Open4D(dat4d)
+    sums, counts = _GroupSums(dat4d, 1, sample, stride, seed, accum, chunk_rows, workers, executor, progress)
+    return (sums[0] / counts[0]).astype(dtype, copy=False)
+
+
+def FitBFDisk(edge: np.ndarray, weights: typing.Optional[np.ndarray] = None) -> typing.Tuple[float, float, float]:
+    """Fit a circle to the edge of the BF disk by algebraic least squares
+
+    Solves x^2 + y^2 = 2 cx x + 2 cy y + (r^2 - cx^2 - cy^2) for all edge pixels, which is linear in
+    the unknowns and therefore needs a single small lstsq call.
+
+    :param edge: Edge pixels of the BF disk (2D bool array, e.g. the edge output of CalibrateRonchigram)
+    :param weights: Optional weight of every pixel, e.g. the gradient magnitude of the Ronchigram
+    :return: X center, Y center and radius (pixels)
+    """
+    y, x = np.nonzero(edge)
+    if x.size < 3: raise ValueError('At least 3 edge pixels are needed to fit the BF disk')
+    x, y = x.astype(float), y.astype(float)
+    w = np.ones(x.size) if weights is None else np.sqrt(np.asarray(weights, dtype=float)[edge])
+    A = np.stack([x, y, np.ones(x.size)], axis=1) * w[:, None]
+    (a, b, c), *_ = np.linalg.lstsq(A, (x ** 2 + y ** 2) * w, rcond=None)
+    cx, cy = a / 2, b / 2
+    return float(cx), float(cy), float(np.sqrt(c + cx ** 2 + cy ** 2))
+
+
+def _CalibrateMean(R: np.ndarray, conv: float, t: float, fit: str) -> typing.Tuple[float, float, float, np.ndarray, float, np.ndarray]:
+    """Center and pixels/mrad calibration of a mean Ronchigram"""
     Rn = (R - np.amin(R)) / np.ptp(R)
     BFdisk = np.ones(R.shape) * (Rn > t)
     absct = t * np.ptp(R)
     rxx, ryy = np.meshgrid(np.arange(0, Rn.shape[1]), np.arange(0, Rn.shape[0]))
-    rcx, rcy = np.sum(BFdisk * rxx / np.sum(BFdisk)), np.sum(BFdisk * ryy / np.sum(BFdisk))
     edge = (np.sum(np.abs(np.gradient(BFdisk)), axis=0)) > t
+    if fit == 'circle':
+        gy, gx = np.gradient(Rn)
+        rcx, rcy, radius = FitBFDisk(edge, np.hypot(gx, gy))
+        return rcx, rcy, radius / conv, BFdisk, absct, edge
+    if fit != 'centroid': raise ValueError('Unknown fit ' + repr(fit))
+    rcx, rcy = np.sum(BFdisk * rxx / np.sum(BFdisk)), np.sum(BFdisk * ryy / np.sum(BFdisk))
     pixcal = np.average(np.sqrt((rxx - rcx) ** 2 + (ryy - rcy) ** 2)[edge]) / conv
-    return R, rcx, rcy, pixcal, BFdisk, absct, edge
+    return rcx, rcy, pixcal, BFdisk, absct, edge
 
 
-def GetDetectorImage(dat4d: np.ndarray, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32) -> np.ndarray:
-    """Reconstruct a detector image from the 4D Dataset
+@_Instrumented
+def CalibrateRonchigram(dat4d: Dataset4D, conv: float = 32, t: float = 0.3, *, fit: str = 'centroid', sample: typing.Optional[float] = None, stride: typing.Union[None, int, typing.Tuple[int, int]] = None, seed: typing.Optional[int] = None, outputerr: bool = False, groups: int = 8, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> typing.Tuple:
+    """Find true center of Ronchigram, and pixels/mrad calibration
+
+    With sample or stride only a subset of the Ronchigrams is read, which is usually enough to
+    calibrate a large 4D Dataset in seconds. The error estimate splits the Ronchigrams into groups,
+    calibrates every group separately and reports the standard error of their mean.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param conv: Convergence Angle of Electron Probe in mrad
+    :param t: Threshhold for BF Disk (fraction of 1)
+    :param fit: 'centroid' of the thresholded BF disk, or sub-pixel 'circle' fit to its edge
+    :param sample: Use only this number of random scan positions (or fraction of them if below 1)
+    :param stride: Use only every stride-th scan position along both axes, or (Y, X) steps
+    :param seed: Seed of the random sample
+    :param outputerr: Also return the standard errors of the center and calibration (bool)
+    :param groups: Number of groups the error estimate is based on
+    :param dtype: Type of the mean Ronchigram
+    :param accum: Precision of the sums within a block (np.float32 or np.float64), blocks are combined in float64
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: center, calibrations, and with outputerr the errors of (X center, Y center, calibration)
+    """
+    dat4d = _Open4D(dat4d)
+    sums, counts = _GroupSums(dat4d, groups if outputerr else 1, sample, stride, seed, accum, chunk_rows, workers, executor, progress)
+    R = np.sum(sums, axis=0) / np.sum(counts)
+    rcx, rcy, pixcal, BFdisk, absct, edge = _CalibrateMean(R, conv, t, fit)
+    result = (R.astype(dtype, copy=False), rcx, rcy, pixcal, BFdisk, absct, edge)
+    if not outputerr: return result
+    used = counts > 0
+    if np.count_nonzero(used) < 2: raise ValueError('At least 2 non-empty groups are needed for the error estimate')
+    estimates = np.array([_CalibrateMean(s / n, conv, t, fit)[:3] for s, n in zip(sums[used], counts[used])])
+    err = np.std(estimates, axis=0, ddof=1) / np.sqrt(len(estimates))
+    return result + (tuple(float(e) for e in err),)
+
+
+def _AnnularWeights(shape: typing.Tuple[int, int], RCX: float, RCY: float, RCal: float, radii: typing.Sequence[DetectorSpec], com: bool = True) -> typing.Tuple[typing.Optional[np.ndarray], np.ndarray]:
+    """Compile annular detectors into a list of Ronchigram pixels and a weight matrix
+
+    Every annulus contributes an intensity channel and, with com, an X and a Y channel, so a
+    stack of Ronchigrams can be reduced to all of them with a single matrix product.
+
+    :param shape: Shape of a single Ronchigram (pixels)
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param radii: Sequence of (Inner, Outer) radii in mrad, or (Inner, Outer, Start, End) for segments with angles in radians
+    :param com: Include the CoM-X and CoM-Y channels for every annulus
+    :return: flattened pixel indices (None if all pixels are used), weights as (pixels, channels) ndarray
+    """
+    NY, NX = shape
+    X, Y = np.meshgrid((np.arange(0, NX) - RCX) / RCal, (np.arange(0, NY) - RCY) / RCal)
+    X, Y = X.ravel(), Y.ravel()
+    R2 = X ** 2 + Y ** 2
+    T = np.arctan2(Y, X) % (2 * np.pi)
+    channels = []
+    for spec in radii:
+        RI, RO = spec[:2]
+        mask = (R2 >= RI ** 2) & (R2 < RO ** 2)
+        # Segments spanning the whole circle are plain annuli, the modulo below would make them empty
+        if len(spec) == 4 and spec[3] - spec[2] < 2 * np.pi: mask &= (T - spec[2]) % (2 * np.pi) < (spec[3] - spec[2]) % (2 * np.pi)
+        mask = mask.astype(float)
+        channels.append(mask)
+        if com: channels.extend([mask * X, mask * Y])
+    weights = np.stack(channels, axis=1) / (NY * NX)
+    idx = np.flatnonzero(np.any(weights != 0, axis=1))
+    # Gathering the used pixels only pays off when the annuli cover a small part of the Ronchigram
+    if idx.size > weights.shape[0] // 2: return None, weights
+    return idx, weights[idx]
+
+
+class DetectorPlan:
+    """Virtual detector geometry compiled once into the pixel indices and weights used by the reductions
+
+    Plans are immutable and shared, use GetDetectorPlan to get a cached one.
+
+    :param shape: Shape of a single Ronchigram (pixels)
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param radii: Sequence of (Inner, Outer) radii in mrad, or (Inner, Outer, Start, End) for segments with angles in radians, one per detector
+    :param com: Include the CoM-X and CoM-Y channels for every detector
+    """
+
+    def __init__(self, shape: typing.Tuple[int, int], RCX: float, RCY: float, RCal: float, radii: typing.Sequence[DetectorSpec] = ((0, 32),), com: bool = True):
+        self.shape = tuple(int(n) for n in shape)
+        self.RCX, self.RCY, self.RCal = float(RCX), float(RCY), float(RCal)
+        self.radii = tuple(tuple(float(v) for v in spec) for spec in radii)
+        self.com = bool(com)
+        self.idx, self.weights = _AnnularWeights(self.shape, self.RCX, self.RCY, self.RCal, self.radii, self.com)
+        for array in (self.idx, self.weights):
+            if array is not None: array.flags.writeable = False
+        self._typed = {self.weights.dtype: self.weights}
+
+    def typed_weights(self, dtype: np.dtype) -> np.ndarray:
+        """Weights converted once to the accumulation type of the reductions"""
+        dtype = np.dtype(dtype)
+        if dtype not in self._typed:
+            weights = self.weights.astype(dtype)
+            weights.flags.writeable = False
+            self._typed[dtype] = weights
+        return self._typed[dtype]
+
+    @property
+    def channels(self) -> int:
+        return self.weights.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.weights.nbytes + (self.idx.nbytes if self.idx is not None else 0)
+
+    def check(self, shape: typing.Tuple[int, ...]):
+        if tuple(shape[-2:]) != self.shape:
+            raise ValueError('Detector plan was compiled for '+str(self.shape)+' Ronchigrams, not '+str(tuple(shape[-2:])))
+
+    def unpack(self, out: np.ndarray) -> typing.List:
+        """Split reduced channels into one detector image, or (detector image, iCoM X, iCoM Y) tuple, per detector"""
+        if not self.com: return [out[..., i] for i in range(len(self.radii))]
+        return [(out[..., 3 * i], out[..., 3 * i + 1], out[..., 3 * i + 2]) for i in range(len(self.radii))]
+
+
+@functools.lru_cache(maxsize=32)
+def _CachedDetectorPlan(shape: typing.Tuple[int, int], RCX: float, RCY: float, RCal: float, radii: typing.Tuple[DetectorSpec, ...], com: bool) -> DetectorPlan:
+    return DetectorPlan(shape, RCX, RCY, RCal, radii, com)
+
+
+def GetDetectorPlan(shape: typing.Tuple[int, ...], RCX: float, RCY: float, RCal: float, radii: typing.Sequence[DetectorSpec] = ((0, 32),), com: bool = True) -> DetectorPlan:
+    """Get the detector plan for a Ronchigram shape and calibration from a least-recently-used cache
+
+    :param shape: Shape of a single Ronchigram, or of the whole 4D Dataset
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param radii: Sequence of (Inner, Outer) radii in mrad, or (Inner, Outer, Start, End) for segments with angles in radians, one per detector
+    :param com: Include the CoM-X and CoM-Y channels for every detector
+    :return: shared DetectorPlan
+    """
+    shape = tuple(int(n) for n in shape[-2:])
+    radii = tuple(tuple(float(v) for v in spec) for spec in radii)
+    return _CachedDetectorPlan(shape, float(RCX), float(RCY), float(RCal), radii, bool(com))
+
+
+def _ProjectRowBlock(block: np.ndarray, idx: typing.Optional[np.ndarray], weights: np.ndarray) -> np.ndarray:
+    rows, SX, NY, NX = block.shape
+    block = block.reshape(-1, NY * NX)
+    if idx is not None: block = block[:, idx]
+    # Blocks are read in their native type, only this block is converted to the accumulation type
+    return np.dot(block.astype(weights.dtype, copy=False), weights).reshape(rows, SX, weights.shape[1])
+
+
+def _ReduceRonchigrams(dat4d: np.ndarray, plan: DetectorPlan, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> np.ndarray:
+    """Project every Ronchigram onto the detector weights, a few scan rows at a time
+
+    Only one block of scan rows is ever expanded to floating point, so memory is bounded by the
+    output plus a single block instead of by full-size masked copies of the 4D Dataset.
 
     :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions
+    :param plan: Compiled detector geometry
+    :param dtype: Type of the reduced maps
+    :param accum: Precision of the reduction (np.float32 or np.float64)
+    :param chunk_rows: Number of scan rows reduced per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: reduced channels as (scan y, scan x, channels) ndarray
+    """
+    plan.check(dat4d.shape)
+    blocks = _MapRowBlocks(dat4d, _ProjectRowBlock, (plan.idx, plan.typed_weights(accum)), chunk_rows, workers, executor, progress)
+    return np.concatenate(blocks, axis=0).astype(dtype, copy=False)
+
+
+class DescanMap:
+    """Low-order polynomial map of the BF disk center across the scan
+
+    Descan drift moves the BF disk with the scan position. The CoM channels of a reduction are
+    measured from the fixed center of the detector plan, and can be referred to the local center
+    afterwards with the intensity channel of the same pass: X - (cx(p) - RCX) / RCal * I. This only
+    holds while the detector contains the whole disk at every position, the detector mask itself stays
+    centered on RCX, RCY, so its outer radius must exceed the disk radius plus the largest shift.
+
+    :param scan: Number of scan positions (Y, X)
+    :param coefx: Coefficients of the X center (pixels), one per polynomial term
+    :param coefy: Coefficients of the Y center (pixels), one per polynomial term
+    :param order: Polynomial order in the scan position (1 for a plane)
+    :param radius: Radius of the BF disk (pixels), if known
+    """
+
+    def __init__(self, scan: typing.Tuple[int, int], coefx: typing.Sequence[float], coefy: typing.Sequence[float], order: int = 1, radius: typing.Optional[float] = None):
+        self.scan = tuple(int(n) for n in scan[:2])
+        self.order = int(order)
+        self.radius = None if radius is None else float(radius)
+        self.coefx, self.coefy = np.asarray(coefx, dtype=float), np.asarray(coefy, dtype=float)
+        if self.coefx.shape != (self.terms(self.order),) or self.coefy.shape != self.coefx.shape:
+            raise ValueError('A descan map of order ' + str(self.order) + ' needs ' + str(self.terms(self.order)) + ' coefficients per axis')
+
+    @staticmethod
+    def terms(order: int) -> int:
+        return (order + 1) * (order + 2) // 2
+
+    @staticmethod
+    def design(rows: np.ndarray, cols: np.ndarray, scan: typing.Tuple[int, int], order: int) -> np.ndarray:
+        """Polynomial terms of the scan positions, normalized to 0-1 so the fit stays well conditioned"""
+        u = np.asarray(rows, dtype=float) / max(scan[0] - 1, 1)
+        v = np.asarray(cols, dtype=float) / max(scan[1] - 1, 1)
+        return np.stack([u ** i * v ** j for i in range(order + 1) for j in range(order + 1 - i)], axis=-1)
+
+    def center(self, rows: slice = slice(None)) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """X and Y center of the BF disk (pixels) for a range of scan rows"""
+        rr, cc = np.meshgrid(np.arange(self.scan[0])[rows], np.arange(self.scan[1]), indexing='ij')
+        A = self.design(rr, cc, self.scan, self.order)
+        return A @ self.coefx, A @ self.coefy
+
+    def shift(self, RCX: float, RCY: float) -> float:
+        """Largest distance of the BF disk center from RCX, RCY over the scan (pixels)"""
+        cx, cy = self.center()
+        return float(np.max(np.hypot(cx - RCX, cy - RCY)))
+
+    def check(self, plan: DetectorPlan):
+        """Warn about the detectors of plan that do not contain the BF disk at every scan position"""
+        if not plan.com or self.radius is None: return
+        needed = (self.radius + self.shift(plan.RCX, plan.RCY)) / plan.RCal
+        for spec in plan.radii:
+            if spec[1] < needed:
+                _log.warning('Descan correction of the %g-%g mrad detector is not valid, the BF disk crosses its outer edge (needs at least %.1f mrad)', spec[0], spec[1], needed)
+
+    def correct(self, out: np.ndarray, plan: DetectorPlan, rows: slice = slice(None)):
+        """Refer the CoM channels of reduced maps (scan y, scan x, channels) to the local center, in place"""
+        if not plan.com: return
+        cx, cy = self.center(rows)
+        dx, dy = (cx - plan.RCX) / plan.RCal, (cy - plan.RCY) / plan.RCal
+        for i in range(len(plan.radii)):
+            out[..., 3 * i + 1] -= (dx * out[..., 3 * i]).astype(out.dtype, copy=False)
+            out[..., 3 * i + 2] -= (dy * out[..., 3 * i]).astype(out.dtype, copy=False)
+
+
+def _DiskRowBlock(block: np.ndarray) -> np.ndarray:
+    """Intensity-weighted (X, Y) center and radius of the pixels above half maximum of every Ronchigram of a block"""
+    NY, NX = block.shape[-2:]
+    block = block.astype(float, copy=False)
+    total = np.sum(block, axis=(-2, -1))
+    total[total == 0] = 1
+    cx = np.einsum('...yx,x->...', block, np.arange(NX, dtype=float)) / total
+    cy = np.einsum('...yx,y->...', block, np.arange(NY, dtype=float)) / total
+    area = np.count_nonzero(block > np.max(block, axis=(-2, -1), keepdims=True) / 2, axis=(-2, -1))
+    return np.stack([cx, cy, np.sqrt(area / np.pi)], axis=-1)
+
+
+@_Instrumented
+def GetDescanMap(dat4d: Dataset4D, *, order: int = 1, sample: typing.Optional[float] = 256, stride: typing.Union[None, int, typing.Tuple[int, int]] = None, seed: typing.Optional[int] = None, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> DescanMap:
+    """Fit the BF disk center across the scan from a sparse set of Ronchigrams
+
+    The center of every sampled Ronchigram is its intensity-weighted center of mass. The fit is of
+    low order, so the specimen deflections average out and only the smooth descan drift remains.
+    The correction needs detectors that contain the whole BF disk at every scan position, the map
+    also keeps the median disk radius so GetVirtualDetectors and IncrementalCoM warn otherwise.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param order: Polynomial order in the scan position (1 for a plane)
+    :param sample: Number of random scan positions (or fraction of them if below 1), None for all
+    :param stride: Use only every stride-th scan position along both axes, or (Y, X) steps
+    :param seed: Seed of the random sample
+    :param chunk_rows: Number of scan rows read per block when all positions are used (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel when all positions are used (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: DescanMap to pass to GetiCoM, GetVirtualDetectors, GetDetectorBank or IncrementalCoM
+    """
+    dat4d = _Open4D(dat4d)
+    NY, NX = dat4d.shape[2:]
+    rows, cols = _SamplePositions(dat4d.shape, sample, stride, seed)
+    if rows.size < DescanMap.terms(order): raise ValueError('Too few scan positions for a descan map of order ' + str(order))
+    if sample is None and stride is None:
+        # All positions are streamed in blocks of scan rows, only the centers are kept
+        disks = np.concatenate(_MapRowBlocks(dat4d, _DiskRowBlock, (), chunk_rows, workers, executor, progress), axis=0)
+        cx, cy, radius = disks[rows, cols].T
+    else:
+        # Sampled Ronchigrams are read one scan row at a time, so only one row of them is ever expanded
+        cx, cy, radius = np.empty(rows.size), np.empty(rows.size), np.empty(rows.size)
+        for row in np.unique(rows):
+            picked = rows == row
+            cx[picked], cy[picked], radius[picked] = _DiskRowBlock(np.asarray(dat4d[row, cols[picked]])).T
+        _CountRead(rows.size, rows.size * NY * NX * dat4d.dtype.itemsize)
+    A = DescanMap.design(rows, cols, dat4d.shape, order)
+    coefx, coefy = np.linalg.lstsq(A, np.stack([cx, cy], axis=1), rcond=None)[0].T
+    return DescanMap(dat4d.shape, coefx, coefy, order, float(np.median(radius)))
+
+
+@_Instrumented
+def GetVirtualDetectors(dat4d: Dataset4D, RCX: float, RCY: float, RCal: float, radii: typing.Sequence[DetectorSpec] = ((0, 32),), *, com: bool = True, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None, plan: typing.Optional[DetectorPlan] = None, descan: typing.Optional[DescanMap] = None) -> typing.List:
+    """Reconstruct detector images and CoM shifts for several annular detectors in a single pass
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param radii: Sequence of (Inner, Outer) radii in mrad, or (Inner, Outer, Start, End) for segments with angles in radians, one per detector
+    :param com: Also return the CoM shifts measured within every detector (bool)
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the reduction (np.float32 or np.float64), data are read in their native type
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :param plan: Precompiled detector geometry, replaces RCX, RCY, RCal, radii and com
+    :param descan: Measure the CoM shifts from the BF disk center of this DescanMap instead of RCX, RCY, the detectors must contain the disk at every position
+    :return: list with one (detector image, iCoM X, iCoM Y) tuple per detector, or one detector image per detector if com is False
+    """
+    dat4d = _Open4D(dat4d)
+    if plan is None: plan = GetDetectorPlan(dat4d.shape, RCX, RCY, RCal, radii, com)
+    out = _ReduceRonchigrams(dat4d, plan, dtype, accum, chunk_rows, workers, executor, progress)
+    if descan is not None:
+        descan.check(plan)
+        descan.correct(out, plan)
+    return plan.unpack(out)
+
+
+def StandardDetectors(conv: float = 32, *, quadrants: bool = True) -> typing.Dict[str, DetectorSpec]:
+    """Conventional STEM detectors scaled to the convergence angle
+
+    :param conv: Convergence Angle of Electron Probe in mrad
+    :param quadrants: Add the four quadrants of the BF disk as segmented detectors (bool)
+    :return: detector specifications by name, in the order BF, ABF, LAADF, HAADF (, Q1-Q4)
+    """
+    detectors = collections.OrderedDict()
+    detectors['BF'] = (0, conv)
+    detectors['ABF'] = (conv / 2, conv)
+    detectors['LAADF'] = (conv * 1.1, conv * 2.5)
+    detectors['HAADF'] = (conv * 2.5, conv * 6)
+    if quadrants:
+        for i in range(4): detectors['Q' + str(i + 1)] = (0, conv, i * np.pi / 2, (i + 1) * np.pi / 2)
+    return detectors
+
+
+@_Instrumented
+def GetDetectorBank(dat4d: Dataset4D, RCX: float, RCY: float, RCal: float, detectors: typing.Optional[typing.Mapping[str, DetectorSpec]] = None, *, conv: float = 32, com: bool = True, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None, descan: typing.Optional[DescanMap] = None) -> typing.Dict:
+    """Reconstruct a whole bank of virtual detectors with a single read of the 4D Dataset
+
+    All detectors are stacked into one weight matrix, so every block of Ronchigrams is reduced by
+    one matrix product no matter how many detectors are requested.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param detectors: Detector specifications by name (default: StandardDetectors(conv))
+    :param conv: Convergence Angle of Electron Probe in mrad, used for the default detectors
+    :param com: Also return the CoM shifts measured within every detector (bool)
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the reduction (np.float32 or np.float64), data are read in their native type
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :param descan: Measure the CoM shifts from the BF disk center of this DescanMap instead of RCX, RCY, the detectors must contain the disk at every position
+    :return: detector image, or (detector image, iCoM X, iCoM Y) tuple if com, by detector name
+    """
+    if detectors is None: detectors = StandardDetectors(conv)
+    images = GetVirtualDetectors(dat4d, RCX, RCY, RCal, list(detectors.values()), com=com, dtype=dtype, accum=accum, chunk_rows=chunk_rows, workers=workers, executor=executor, progress=progress, descan=descan)
+    return collections.OrderedDict(zip(detectors.keys(), images))
+
+
+@_Instrumented
+def GetDetectorImage(dat4d: Dataset4D, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32, *, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None, plan: typing.Optional[DetectorPlan] = None) -> np.ndarray:
+    """Reconstruct a detector image from the 4D Dataset
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
     :param RCX: X Center of the Ronchigram (pixels)
     :param RCY: Y Center of the Ronchigram (pixels)
     :param RCal: Calibration of the Ronchigram (pixels/mrad)
     :param RI: Inner Radius for CoM Measurement (mrad)
     :param RO: Outer Radius for CoM Measurement (mrad)
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the reduction (np.float32 or np.float64), data are read in their native type
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :param plan: Precompiled detector geometry, replaces RCX, RCY, RCal, RI and RO (first detector is used)
     :return detector image as ndarray
     """
-    X, Y = np.meshgrid((np.arange(0, dat4d.shape[3]) - RCX) / RCal, (np.arange(0, dat4d.shape[2]) - RCY) / RCal)
-    return np.average(dat4d * ((X ** 2 + Y ** 2 >= RI ** 2) & (X ** 2 + Y ** 2 < RO ** 2)), axis=(2, 3))
+    # Shares the cached plan of GetiCoM, the extra CoM channels cost next to nothing in the same pass
+    detector = GetVirtualDetectors(dat4d, RCX, RCY, RCal, [(RI, RO)], dtype=dtype, accum=accum, chunk_rows=chunk_rows, workers=workers, executor=executor, progress=progress, plan=plan)[0]
+    return detector[0] if isinstance(detector, tuple) else detector
 
 
-def GetiCoM(dat4d: np.ndarray, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32) -> typing.Tuple[np.ndarray, np.ndarray]:
+@_Instrumented
+def GetiCoM(dat4d: Dataset4D, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32, *, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None, plan: typing.Optional[DetectorPlan] = None, descan: typing.Optional[DescanMap] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
     """Get Ronchigram Center of Mass Shifts from 4D Dataset
 
-    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
     :param RCX: X Center of the Ronchigram (pixels)
     :param RCY: Y Center of the Ronchigram (pixels)
     :param RCal: Calibration of the Ronchigram (pixels/mrad)
     :param RI: Inner Radius for CoM Measurement (mrad)
     :param RO: Outer Radius for CoM Measurement (mrad)
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the reduction (np.float32 or np.float64), data are read in their native type
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :param plan: Precompiled detector geometry with com, replaces RCX, RCY, RCal, RI and RO (first detector is used)
+    :param descan: Measure the CoM shifts from the BF disk center of this DescanMap instead of RCX, RCY, the detector must contain the disk at every position
     :return iCoM as ndarray
     """
-    X, Y = np.meshgrid((np.arange(0, dat4d.shape[3]) - RCX) / RCal, (np.arange(0, dat4d.shape[2]) - RCY) / RCal)
-    maskeddat4d = dat4d * ((X ** 2 + Y ** 2 >= RI ** 2) & (X ** 2 + Y ** 2 < RO ** 2))
-    return np.average(maskeddat4d * X, axis=(2, 3)), np.average(maskeddat4d * Y, axis=(2, 3))
+    if plan is not None and not plan.com: raise ValueError('GetiCoM needs a detector plan compiled with com')
+    detector = GetVirtualDetectors(dat4d, RCX, RCY, RCal, [(RI, RO)], dtype=dtype, accum=accum, chunk_rows=chunk_rows, workers=workers, executor=executor, progress=progress, plan=plan, descan=descan)[0]
+    return detector[1], detector[2]
+
+
+def _DiskTemplate(template: np.ndarray, sigma: float, accum: np.dtype) -> np.ndarray:
+    """Conjugate spectrum of the edge-filtered template
+
+    Correlating the gradients of two images equals correlating the images with |k|^2 applied to one
+    spectrum, so the whole edge filter (a Gaussian-smoothed gradient) is folded into the template.
+    """
+    NY, NX = template.shape
+    ky, kx = np.fft.fftfreq(NY)[:, None], np.fft.rfftfreq(NX)[None, :]
+    k2 = kx ** 2 + ky ** 2
+    H = k2 * np.exp(-(2 * np.pi * sigma) ** 2 * k2)
+    import scipy.fft
+    ctype = np.result_type(accum, np.complex64)
+    return (np.conj(scipy.fft.rfft2(template.astype(float))) * H).astype(ctype)
+
+
+def _DiskWindow(template: np.ndarray, margin: int) -> typing.Tuple[slice, slice]:
+    """Part of the Ronchigram around the disk of the template, grown to fast FFT sizes where possible"""
+    import scipy.fft
+    window = []
+    for axis, N in enumerate(template.shape):
+        used = np.flatnonzero(np.any(template > 0.5 * np.amax(template), axis=1 - axis))
+        if used.size == 0: return slice(None), slice(None)
+        size = min(N, scipy.fft.next_fast_len(int(used[-1] - used[0] + 1 + 2 * margin), real=True))
+        start = int(np.clip((used[0] + used[-1] + 1 - size) // 2, 0, N - size))
+        window.append(slice(start, start + size))
+    return window[0], window[1]
+
+
+def _RegisterRowBlock(block: np.ndarray, fT: np.ndarray, window: typing.Tuple[slice, slice]) -> np.ndarray:
+    """Sub-pixel shifts (pixels) of every Ronchigram of a block against the template, from one batched FFT"""
+    import scipy.fft
+    block = block[..., window[0], window[1]]
+    rows, SX, NY, NX = block.shape
+    frames = block.reshape(-1, NY, NX).astype(fT.real.dtype, copy=False)
+    C = scipy.fft.irfft2(scipy.fft.rfft2(frames) * fT, s=(NY, NX))
+    peak = np.argmax(C.reshape(len(frames), -1), axis=1)
+    f, py, px = np.arange(len(frames)), peak // NX, peak % NX
+    c0 = C[f, py, px]
+
+    def Refine(cm, cp):
+        # Vertex of the parabola through the peak and its two neighbours
+        d = cm - 2 * c0 + cp
+        return np.where(d < 0, 0.5 * (cm - cp) / np.where(d < 0, d, 1), 0)
+
+    dx = Refine(C[f, py, (px - 1) % NX], C[f, py, (px + 1) % NX])
+    dy = Refine(C[f, (py - 1) % NY, px], C[f, (py + 1) % NY, px])
+    sx = (px + NX // 2) % NX - NX // 2 + dx
+    sy = (py + NY // 2) % NY - NY // 2 + dy
+    return np.stack([sx, sy], axis=-1).reshape(rows, SX, 2)
+
+
+@_Instrumented
+def GetDiskShifts(dat4d: Dataset4D, template: np.ndarray, RCal: float = 1, *, sigma: float = 1, margin: int = 8, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Get BF Disk Shifts by registering every Ronchigram against a template of the disk
+
+    Unlike the CoM, the shift of the disk edge does not depend on the intensity distribution inside
+    the disk and is robust at low dose. Every block of scan rows is correlated with the edge-filtered
+    template in one batched real FFT, and the correlation peak is refined to sub-pixel precision.
+    Only a window around the disk of the template is transformed, shifts must stay below margin.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param template: Ronchigram the shifts are measured against, e.g. BFdisk or R from CalibrateRonchigram
+    :param RCal: Calibration of the Ronchigram (pixels/mrad), 1 for shifts in pixels
+    :param sigma: Width of the Gaussian smoothing of the edge filter (pixels)
+    :param margin: Largest expected shift (pixels), the transformed window extends this far beyond the disk
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the FFTs (np.float32 or np.float64)
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks registered in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: disk shifts X and Y (mrad) as ndarray
+    """
+    dat4d = _Open4D(dat4d)
+    if tuple(template.shape) != tuple(dat4d.shape[2:]): raise ValueError('Template of shape ' + str(template.shape) + ' does not match Ronchigrams of shape ' + str(dat4d.shape[2:]))
+    template = np.asarray(template)
+    window = _DiskWindow(template, int(margin))
+    fT = _DiskTemplate(template[window], sigma, accum)
+    blocks = _MapRowBlocks(dat4d, _RegisterRowBlock, (fT, window), chunk_rows, workers, executor, progress)
+    shifts = np.concatenate(blocks, axis=0) / RCal
+    return shifts[..., 0].astype(dtype), shifts[..., 1].astype(dtype)
+
+
+def _SeriesFrames(series: Dataset5D) -> typing.List:
+    """4D Datasets of a series, frames of a 5D memmap stay memmaps so worker processes can reopen them"""
+    if isinstance(series, (str, os.PathLike)): series = np.load(series, mmap_mode='r')
+    if not isinstance(series, np.ndarray): return [_Open4D(frame) for frame in series]
+    if series.ndim != 5: raise ValueError('A 5D series of 4D Datasets is needed, not ' + str(series.ndim) + 'D')
+    return [series[t] for t in range(series.shape[0])]
+
+
+def _FrameProgress(progress: typing.Optional[ProgressCallback], t: int, frames: int) -> typing.Optional[ProgressCallback]:
+    """Report the blocks of frame t as part of the whole series"""
+    if progress is None: return None
+    return lambda done, total: progress(t * total + done, frames * total)
+
+
+@_Instrumented
+def CalibrateSeries(series: Dataset5D, conv: float = 32, t: float = 0.3, *, track: typing.Optional[float] = None, fit: str = 'centroid', sample: typing.Optional[float] = None, stride: typing.Union[None, int, typing.Tuple[int, int]] = None, seed: typing.Optional[int] = None, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> typing.Tuple:
+    """Calibrate a series of 4D Datasets once from its first frame, optionally tracking the BF disk center across frames
+
+    :param series: Series of 4D Datasets (5D array or memmap with time first, path to a 5D .npy file, or sequence of 4D Datasets)
+    :param conv: Convergence Angle of Electron Probe in mrad
+    :param t: Threshhold for BF Disk (fraction of 1)
+    :param track: Find the center of every frame from this number (or fraction) of random scan positions, None to use the first center for all
+    :param fit: 'centroid' of the thresholded BF disk, or sub-pixel 'circle' fit to its edge
+    :param sample: Calibrate the first frame from this number of random scan positions (or fraction of them if below 1)
+    :param stride: Calibrate the first frame from every stride-th scan position along both axes, or (Y, X) steps
+    :param seed: Seed of the random samples
+    :param dtype: Type of the mean Ronchigram
+    :param accum: Precision of the sums within a block (np.float32 or np.float64), blocks are combined in float64
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: the results of CalibrateRonchigram for the first frame, followed by the (X, Y) centers of all frames (frames x 2 array), all tracked ones found alike so their differences are the drift
+    """
+    frames = _SeriesFrames(series)
+    steps = len(frames) + 1 if track is not None else 1
+    options = {'accum': accum, 'chunk_rows': chunk_rows, 'workers': workers, 'executor': executor}
+    result = CalibrateRonchigram(frames[0], conv, t, fit=fit, sample=sample, stride=stride, seed=seed, dtype=dtype, progress=_FrameProgress(progress, 0, steps), **options)
+    centers = np.empty((len(frames), 2))
+    centers[:] = result[1], result[2]
+    if track is None: return result + (centers,)
+    # The first frame is tracked from the same sample as the others, a different sample would show up as drift
+    for i in range(len(frames)):
+        R = GetMeanRonchigram(frames[i], sample=track, seed=seed, dtype=np.float64, progress=_FrameProgress(progress, i + 1, steps), **options)
+        centers[i] = _CalibrateMean(R, conv, t, fit)[:2]
+    return result + (centers,)
+
+
+@_Instrumented
+def GetSeriesDetectors(series: Dataset5D, RCX: float, RCY: float, RCal: float, radii: typing.Sequence[DetectorSpec] = ((0, 32),), *, centers: typing.Optional[np.ndarray] = None, com: bool = True, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> typing.List:
+    """Detector images and CoM shifts of every frame of a series, read in a single pass
+
+    :param series: Series of 4D Datasets (5D array or memmap with time first, path to a 5D .npy file, or sequence of 4D Datasets)
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param radii: Sequence of (Inner, Outer) radii in mrad, or (Inner, Outer, Start, End) for segments with angles in radians, one per detector
+    :param centers: (X, Y) center of every frame (frames x 2 array from CalibrateSeries with track), replaces RCX and RCY
+    :param com: Also return the CoM shifts measured within every detector (bool)
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the reduction (np.float32 or np.float64), data are read in their native type
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: list with one (detector images, iCoM X, iCoM Y) tuple of frames x SY x SX stacks per detector, or one stack of detector images per detector if com is False
+    """
+    frames = _SeriesFrames(series)
+    if centers is not None and len(centers) != len(frames): raise ValueError('One center per frame is needed, not ' + str(len(centers)))
+    stacks = None
+    for i, frame in enumerate(frames):
+        cx, cy = (RCX, RCY) if centers is None else centers[i]
+        plan = GetDetectorPlan(frame.shape, float(cx), float(cy), RCal, radii, com)
+        out = _ReduceRonchigrams(frame, plan, dtype, accum, chunk_rows, workers, executor, _FrameProgress(progress, i, len(frames)))
+        # Frames are reduced into one preallocated stack instead of being stacked at the end
+        if stacks is None: stacks = np.empty((len(frames),) + out.shape, out.dtype)
+        stacks[i] = out
+    return plan.unpack(stacks)
+
+
+def GetSeriesCoM(series: Dataset5D, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32, *, centers: typing.Optional[np.ndarray] = None, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Ronchigram Center of Mass Shifts of every frame of a series
+
+    The returned stacks can be passed directly to GetPLRotation, GetChargeDensity, GetElectricFields
+    and GetPotential, which process all frames at once.
+
+    :param series: Series of 4D Datasets (5D array or memmap with time first, path to a 5D .npy file, or sequence of 4D Datasets)
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param RI: Inner Radius for CoM Measurement (mrad)
+    :param RO: Outer Radius for CoM Measurement (mrad)
+    :param centers: (X, Y) center of every frame (frames x 2 array from CalibrateSeries with track), replaces RCX and RCY
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the reduction (np.float32 or np.float64), data are read in their native type
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks reduced in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: iCoM X and Y as frames x SY x SX ndarrays
+    """
+    detector = GetSeriesDetectors(series, RCX, RCY, RCal, [(RI, RO)], centers=centers, dtype=dtype, accum=accum, chunk_rows=chunk_rows, workers=workers, executor=executor, progress=progress)[0]
+    return detector[1], detector[2]
+
+
+def _BinBlock(block: np.ndarray, scan: int, detector: int) -> np.ndarray:
+    """Mean of scan x scan positions and detector x detector pixels, incomplete bins at the ends are dropped"""
+    rows, SX, NY, NX = block.shape
+    rows, SX, NY, NX = rows // scan, SX // scan, NY // detector, NX // detector
+    block = block[:rows * scan, :SX * scan, :NY * detector, :NX * detector]
+    return block.reshape(rows, scan, SX, scan, NY, detector, NX, detector).mean(axis=(1, 3, 5, 7))
+
+
+def _PyramidRowBlock(block: np.ndarray, levels: int, scan: int, detector: int, dtype: np.dtype) -> typing.List[np.ndarray]:
+    binned = []
+    for level in range(levels):
+        # Every level is binned from the previous one, equal bins make this the exact mean of the original
+        block = _BinBlock(block.astype(np.float64, copy=False) if level == 0 else block, scan, detector)
+        binned.append(block)
+    return [level.astype(dtype, copy=False) for level in binned]
+
+
+class Pyramid:
+    """Binned copies of a 4D Dataset for fast previews, level 0 is the original
+
+    Level i bins scan**i x scan**i scan positions and detector**i x detector**i Ronchigram pixels into
+    their mean, so detector images and CoM shifts keep the scale of the full resolution ones.
+
+    :param original: 4D Dataset at full resolution
+    :param levels: Binned 4D Datasets, from fine to coarse
+    :param scan: Binning of the scan per level
+    :param detector: Binning of the Ronchigrams per level
+    """
+
+    def __init__(self, original: Dataset4D, levels: typing.Sequence[np.ndarray], scan: int = 2, detector: int = 2):
+        self.levels = [original] + list(levels)
+        self.scan, self.detector = int(scan), int(detector)
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+    def __getitem__(self, level: int) -> Dataset4D:
+        return self.levels[level]
+
+    @property
+    def coarsest(self) -> int:
+        return len(self.levels) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return sum(level.nbytes for level in self.levels[1:])
+
+    def scale_calibration(self, level: int, RCX: float, RCY: float, RCal: float) -> typing.Tuple[float, float, float]:
+        """Ronchigram center and calibration of the full resolution converted to a level"""
+        f = self.detector ** level
+        return (RCX + 0.5) / f - 0.5, (RCY + 0.5) / f - 0.5, RCal / f
+
+    def unscale_calibration(self, level: int, RCX: float, RCY: float, RCal: float) -> typing.Tuple[float, float, float]:
+        """Ronchigram center and calibration found on a level converted to the full resolution"""
+        f = self.detector ** level
+        return (RCX + 0.5) * f - 0.5, (RCY + 0.5) * f - 0.5, RCal * f
+
+
+@_Instrumented
+def GetPyramid(dat4d: Dataset4D, levels: int = 2, *, scan: int = 2, detector: int = 2, dtype: np.dtype = np.float32, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[ProgressCallback] = None) -> Pyramid:
+    """Bin the scan and the Ronchigrams of a 4D Dataset into several levels with a single read
+
+    The coarse levels are small enough to tune the threshold, center and detector radii interactively
+    with the usual functions (CalibrateRonchigram, GetDetectorImage, GetiCoM, ...), use
+    Pyramid.scale_calibration to pass a full resolution calibration to them.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param levels: Number of binned levels
+    :param scan: Binning of the scan per level (1 to keep all scan positions)
+    :param detector: Binning of the Ronchigrams per level (1 to keep all pixels)
+    :param dtype: Type of the binned levels
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically), rounded to a multiple of scan**levels
+    :param workers: Number of blocks binned in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: Pyramid with the original and the binned levels
+    """
+    dat4d = _Open4D(dat4d)
+    F = scan ** levels
+    if min(dat4d.shape[:2]) < F or min(dat4d.shape[2:]) < detector ** levels: raise ValueError('4D Dataset of shape ' + str(dat4d.shape) + ' is too small for ' + str(levels) + ' levels')
+    rows = _ChunkRows(dat4d.shape, chunk_rows if chunk_rows is not None else getattr(dat4d, 'chunk_rows', None))
+    rows = max(F, rows // F * F)
+    blocks = _MapRowBlocks(dat4d, _PyramidRowBlock, (levels, scan, detector, np.dtype(dtype)), rows, workers, executor, progress)
+    return Pyramid(dat4d, [np.concatenate([block[level] for block in blocks], axis=0) for level in range(levels)], scan, detector)
+
+
+def GetWrittenRows(dat4d: np.ndarray, start: int = 0) -> int:
+    """Count the scan rows of a 4D Dataset that has been filled in row by row during acquisition
+
+    A row counts as written once the Ronchigram at its last scan position contains signal.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions
+    :param start: First row that is not known to be written yet
+    :return: number of written rows
+    """
+    rows = start
+    while rows < dat4d.shape[0] and np.any(dat4d[rows, -1]): rows += 1
+    return rows
+
+
+class IncrementalCoM:
+    """Running detector image and iCoM maps of a 4D Dataset that is still being acquired
+
+    Every update only reduces the scan rows written since the previous one, rows that have not been
+    reached yet stay zero in the maps.
+
+    :param shape: Shape of the 4D Dataset
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param RI: Inner Radius for CoM Measurement (mrad)
+    :param RO: Outer Radius for CoM Measurement (mrad)
+    :param plan: Precompiled detector geometry with com, replaces RCX, RCY, RCal, RI and RO (first detector is used)
+    :param descan: Measure the CoM shifts from the BF disk center of this DescanMap instead of RCX, RCY, the detector must contain the disk at every position
+    """
+
+    def __init__(self, shape: typing.Tuple[int, int, int, int], RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32, *, plan: typing.Optional[DetectorPlan] = None, descan: typing.Optional[DescanMap] = None):
+        self.shape = tuple(shape)
+        if plan is None: plan = GetDetectorPlan(self.shape, RCX, RCY, RCal, [(RI, RO)], com=True)
+        if not plan.com: raise ValueError('IncrementalCoM needs a detector plan compiled with com')
+        plan.check(self.shape)
+        self.plan = plan
+        self.descan = descan
+        if descan is not None: descan.check(plan)
+        self.out = np.zeros(self.shape[:2] + (plan.channels,))
+        self.rows = 0
+
+    @property
+    def done(self) -> bool:
+        return self.rows >= self.shape[0]
+
+    @property
+    def detector(self) -> np.ndarray:
+        return self.out[..., 0]
+
+    @property
+    def comx(self) -> np.ndarray:
+        return self.out[..., 1]
+
+    @property
+    def comy(self) -> np.ndarray:
+        return self.out[..., 2]
+
+    @_Instrumented
+    def update(self, dat4d: np.ndarray, rows: typing.Optional[int] = None) -> int:
+        """Reduce the newly written scan rows
+
+        :param dat4d: 4D Dataset being acquired
+        :param rows: Number of rows written so far (default: detected with GetWrittenRows)
+        :return: number of rows reduced by this update
+        """
+        if rows is None: rows = GetWrittenRows(dat4d, self.rows)
+        rows = min(rows, self.shape[0])
+        if rows <= self.rows: return 0
+        block = np.asarray(dat4d[self.rows:rows])
+        _CountRead(block.shape[0] * block.shape[1], block.nbytes)
+        self.out[self.rows:rows] = _ProjectRowBlock(block, self.plan.idx, self.plan.weights)
+        if self.descan is not None: self.descan.correct(self.out[self.rows:rows], self.plan, slice(self.rows, rows))
+        new, self.rows = rows - self.rows, rows
+        return new
+
+    def reset(self):
+        self.out[...] = 0
+        self.rows = 0
+
+def _CurlDivergenceTerms(dpcx: np.ndarray, dpcy: np.ndarray, sample: typing.Optional[int] = None, seed: typing.Optional[int] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Rotation independent parts of the curl and divergence of the DPC data
+
+    Rotating the DPC vectors by t gives curl = a cos(t) - b sin(t) and divergence = b cos(t) + a sin(t),
+    so a single gradient pass is enough for any number of rotation angles. With sample, the gradients
+    are only evaluated at that many random pixels (same differences as np.gradient). Stacks of maps
+    are differentiated along their last two axes only.
+    """
+    if sample is None or sample >= dpcx.size:
+        gXY, gXX = np.gradient(dpcx, axis=(-2, -1))
+        gYY, gYX = np.gradient(dpcy, axis=(-2, -1))
+        return (gXY - gYX).ravel(), (gXX + gYY).ravel()
+    NY, NX = dpcx.shape[-2:]
+    dpcx, dpcy = dpcx.reshape(-1, NY, NX), dpcy.reshape(-1, NY, NX)
+    flat = np.random.default_rng(seed).choice(dpcx.size, int(sample), replace=False)
+    k, i, j = np.unravel_index(flat, dpcx.shape)
+    ip, im = np.minimum(i + 1, NY - 1), np.maximum(i - 1, 0)
+    jp, jm = np.minimum(j + 1, NX - 1), np.maximum(j - 1, 0)
+    dy = lambda f: (f[k, ip, j] - f[k, im, j]) / (ip - im)
+    dx = lambda f: (f[k, i, jp] - f[k, i, jm]) / (jp - jm)
+    return dy(dpcx) - dx(dpcy), dx(dpcx) + dy(dpcy)
 
-def GetPLRotation(dpcx: np.ndarray, dpcy: np.ndarray, *,  order: int = 3, outputall: bool = False) -> float:
+
+@_Instrumented
+def GetPLRotation(dpcx: np.ndarray, dpcy: np.ndarray, *,  order: int = 3, outputall: bool = False, sample: typing.Optional[int] = None, seed: typing.Optional[int] = None) -> float:
     """Find Rotation from PL Lenses by minimizing curl/maximizing divergence of DPC data
 
-    :param dpcx: X-Component of DPC Data (2D numpy array)
-    :param dpcy: Y-Component of DPC Data (2D numpy array)
-    :param order: Number of times to iterated calculation (int)
+    The spread of the curl only depends on the rotation through cos(2t) and sin(2t), so the optimum is
+    found in closed form from one gradient pass instead of searching over rotated copies of the maps.
+
+    :param dpcx: X-Component of DPC Data (2D numpy array, or stack of 2D maps sharing one rotation)
+    :param dpcy: Y-Component of DPC Data (2D numpy array, or stack of 2D maps sharing one rotation)
+    :param order: Number of times to iterated calculation (int), only used for the curves of outputall
     :param outputall: Output Curl and Divergence curves for all guesses in separate array (bool)
+    :param sample: Optional number of random pixels used to estimate the curl and divergence of large maps
+    :param seed: Optional seed for the random pixel sample
     :return: The true PL Rotation value (Note: Can potentially be off by 180 degrees, determine by checking signs of charge/field/potential)
     """
-    def DPC_ACD(dpcx,dpcy,tlow,thigh):        
-        A,C,D=[],[],[]
-        for t in np.linspace(tlow,thigh,10,endpoint=False):            
-            rdpcx,rdpcy=dpcx*np.cos(t)-dpcy*np.sin(t),dpcx*np.sin(t)+dpcy*np.cos(t)        
-            gXY,gXX=np.gradient(rdpcx);gYY,gYX=np.gradient(rdpcy)        
-            C.append(np.std(gXY-gYX));D.append(np.std(gXX+gYY));A.append(t)
+    a, b = _CurlDivergenceTerms(dpcx, dpcy, sample, seed)
+    a, b = a - np.mean(a), b - np.mean(b)
+    Vaa, Vbb, Vab = np.mean(a * a), np.mean(b * b), np.mean(a * b)
+    def DPC_ACD(tlow,thigh):
+        A=np.linspace(tlow,thigh,10,endpoint=False)
+        C=np.sqrt(np.maximum(np.cos(A)**2*Vaa+np.sin(A)**2*Vbb-2*np.cos(A)*np.sin(A)*Vab,0))
+        D=np.sqrt(np.maximum(np.cos(A)**2*Vbb+np.sin(A)**2*Vaa+2*np.cos(A)*np.sin(A)*Vab,0))
         R=np.average([A[np.argmin(C)],A[np.argmax(D)]])
-        return R,A,C,D
-    RotCalcs=[]
-    RotCalcs.append(DPC_ACD(dpcx,dpcy,0,np.pi))
-    for i in range(1,order): 
-        RotCalcs.append(DPC_ACD(dpcx,dpcy,RotCalcs[i-1][0]-np.pi/(10**i),RotCalcs[i-1][0]+np.pi/(10**i)))
-    if outputall: return RotCalcs
-    else: return RotCalcs[-1][0]
-
-def GetElectricFields(dpcx: np.ndarray, dpcy: np.ndarray, *, rotation: float = 0, LegPix: int = 301, LegRad: float = 0.85) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return R,list(A),list(C),list(D)
+    if outputall:
+        RotCalcs=[]
+        RotCalcs.append(DPC_ACD(0,np.pi))
+        for i in range(1,order):
+            RotCalcs.append(DPC_ACD(RotCalcs[i-1][0]-np.pi/(10**i),RotCalcs[i-1][0]+np.pi/(10**i)))
+        return RotCalcs
+    # var(curl) = (Vaa + Vbb) / 2 + (Vaa - Vbb) / 2 * cos(2t) - Vab * sin(2t) is smallest at 2t = pi - phi
+    phi = np.arctan2(Vab, (Vaa - Vbb) / 2)
+    return float(((np.pi - phi) / 2) % np.pi)
+
+def _Rotation(rotation: typing.Union[float, np.ndarray], ndim: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Cosine and sine of one rotation, or of one rotation per map broadcast over a stack of maps"""
+    rotation = np.asarray(rotation, dtype=float)
+    if rotation.ndim: rotation = rotation.reshape(rotation.shape + (1,) * (ndim - rotation.ndim))
+    return np.cos(rotation), np.sin(rotation)
+
+
+# Index of the (V, T, P, Q) component that forms R, G and B in each sixth of the hue circle
+_HSV_SECTORS = np.array([[0, 1, 2], [3, 0, 2], [2, 0, 1], [2, 3, 0], [1, 2, 0], [0, 2, 3]])
+
+
+def _HSVToRGB(HSV: np.ndarray) -> np.ndarray:
+    """Vectorized HSV to RGB conversion of (..., 3) arrays with values from 0 to 1, same results as matplotlib.colors.hsv_to_rgb"""
+    H, S, V = HSV[..., 0], HSV[..., 1], HSV[..., 2]
+    sector = (H * 6).astype(int)
+    F = H * 6 - sector
+    P = V * (1 - S)
+    Q = V * (1 - S * F)
+    T = V * (1 - S * (1 - F))
+    return np.take_along_axis(np.stack([V, T, P, Q], axis=-1), _HSV_SECTORS[sector % 6], axis=-1)
+
+
+def _DirectionToRGB(X: np.ndarray, Y: np.ndarray, V: np.ndarray, dtype: np.dtype = float) -> np.ndarray:
+    """Color code vector directions as hue and magnitudes (0-1) as value, saturation is always 1"""
+    HSV = np.empty(X.shape + (3,))
+    HSV[..., 0] = np.arctan2(Y, X) / (2 * np.pi) % 1
+    HSV[..., 1] = 1
+    HSV[..., 2] = V
+    RGB = _HSVToRGB(HSV)
+    if np.dtype(dtype) == np.uint8: return np.round(RGB * 255).astype(np.uint8)
+    return RGB.astype(dtype, copy=False)
+
+
+@functools.lru_cache(maxsize=8)
+def _ColorWheelLegend(LegPix: int, LegRad: float) -> np.ndarray:
+    x, y = np.meshgrid(np.linspace(-1, 1, LegPix, endpoint=True), np.linspace(-1, 1, LegPix, endpoint=True))
+    X, Y = x * (x ** 2 + y ** 2 < LegRad ** 2), y * (x ** 2 + y ** 2 < LegRad ** 2)
+    RI = np.sqrt(X ** 2 + Y ** 2) / np.amax(np.sqrt(X ** 2 + Y ** 2))
+    EDirLeg = _DirectionToRGB(X, Y, RI)
+    EDirLeg.flags.writeable = False
+    return EDirLeg
+
+
+@_Instrumented
+def GetElectricFields(dpcx: np.ndarray, dpcy: np.ndarray, *, rotation: float = 0, LegPix: int = 301, LegRad: float = 0.85, dtype: np.dtype = float) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """Convert dpcx and dpcy maps to to a color map where the color corresponds to the angle
 
-    :param dpcx: X-Component of DPC Data (2D numpy array)
-    :param dpcy: Y-Component of DPC Data (2D numpy array)
-    :param rotation: Optional rotation radians
+    :param dpcx: X-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param dpcy: Y-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param rotation: Optional rotation radians, one per map of a stack or shared by all
     :param LegPix: Number of Pixels in Color Wheel Legend
     :param LegRad: Radius of Color Wheel in Legend (0-1)
+    :param dtype: Type of the RGB maps, float types range from 0 to 1, np.uint8 from 0 to 255 for direct display
     :return: The electric fields as a 2D numpy array
     """
     EX = -dpcx
     EY = -dpcy
-    rEX = EX * np.cos(rotation) - EY * np.sin(rotation)
-    rEY = EX * np.sin(rotation) + EY * np.cos(rotation)
+    c, s = _Rotation(rotation, EX.ndim)
+    rEX = EX * c - EY * s
+    rEY = EX * s + EY * c
 
     EMag = np.sqrt(rEX ** 2 + rEY ** 2)
 
-    XY = np.zeros(rEX.shape + (3,), dtype=float)
     M = np.amax(EMag)
-    EMagScale = EMag / M
-    for i in range(rEX.shape[0]):
-        for j in range(rEX.shape[1]):
-            XY[i, j] = np.angle(np.complex(rEX[i, j], rEY[i, j])) / (2 * np.pi) % 1, 1, EMagScale[i, j]
-    EDir=hsv_to_rgb(XY)
-    x, y = np.meshgrid(np.linspace(-1, 1, LegPix, endpoint=True), np.linspace(-1, 1, LegPix, endpoint=True))
-    X, Y = x * (x ** 2 + y ** 2 < LegRad ** 2), y * (x ** 2 + y ** 2 < LegRad ** 2)
-    XYLeg = np.zeros(X.shape + (3,), dtype=float)
-    RI = np.sqrt(X ** 2 + Y ** 2) / np.amax(np.sqrt(X ** 2 + Y ** 2))
-    for i in range(X.shape[0]):
-        for j in range(X.shape[1]):
-            XYLeg[i, j] = np.angle(np.complex(X[i, j], Y[i, j])) / (2 * np.pi) % 1, 1, RI[i, j]
-    EDirLeg=hsv_to_rgb(XYLeg)
+    EDir = _DirectionToRGB(rEX, rEY, EMag / M if M > 0 else EMag, dtype)
+    # The legend never depends on the data, so it is only computed once for every size and radius
+    EDirLeg = _ColorWheelLegend(int(LegPix), float(LegRad))
+    if np.dtype(dtype) == np.uint8: EDirLeg = np.round(EDirLeg * 255).astype(np.uint8)
+    else: EDirLeg = EDirLeg.astype(dtype)
     return EMag, EDir, EDirLeg
 
+@_Instrumented
 def GetChargeDensity(dpcx: np.ndarray, dpcy: np.ndarray, *, rotation: float = 0) -> np.ndarray:
     """Calculate Charge Density from the Divergence of the Ronchigram Shifts
 
-    :param dpcx: X-Component of DPC Data (2D numpy array)
-    :param dpcy: Y-Component of DPC Data (2D numpy array)
-    :param rotation: Optional rotation radians
-    :return: The charge density as a 2D numpy array
+    :param dpcx: X-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param dpcy: Y-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param rotation: Optional rotation radians, one per map of a stack or shared by all
+    :return: The charge density as a 2D numpy array (or stack)
     """
 
-    rdpcx = dpcx * np.cos(rotation) + dpcy * np.sin(rotation)
-    rdpcy = -dpcx * np.sin(rotation) + dpcy * np.cos(rotation)
-    gxx, gyy = np.gradient(rdpcx)[1], np.gradient(rdpcy)[0]
+    c, s = _Rotation(rotation, dpcx.ndim)
+    rdpcx = dpcx * c + dpcy * s
+    rdpcy = -dpcx * s + dpcy * c
+    gxx, gyy = np.gradient(rdpcx, axis=-1), np.gradient(rdpcy, axis=-2)
 
     return - gxx - gyy
 
 
-def GetPotential(dpcx: np.ndarray, dpcy: np.ndarray, *, rotation: float = 0, hpass: float = 0, lpass: float = 0) -> np.ndarray:
+def _FrequencyGrid(P: int, K: int, centered: bool) -> np.ndarray:
+    """Spatial frequencies of the inverse gradient in FFT order, spaced 2 / (K - 1) like np.linspace(-1, 1, K)
+
+    The original grid is np.linspace(-1, 1, K) itself, which has no exact zero for even K. Padded
+    transforms use exactly centered frequencies with the same spacing.
+    """
+    if centered: return np.fft.fftfreq(P) * P * 2 / max(K - 1, 1)
+    return np.fft.ifftshift(np.linspace(-1, 1, K, endpoint=True))
+
+
+class PotentialSolver:
+    """Inverse gradient of DPC data with the forward transforms cached for repeated filter tuning
+
+    The rotated components are transformed once with real FFTs, every call of solve only applies the
+    high/low-pass filter and one inverse real FFT. Stacks of maps are transformed together in one
+    batched FFT over their last two axes.
+
+    :param dpcx: X-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param dpcy: Y-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param rotation: Optional rotation radians, one per map of a stack or shared by all
+    :param pad: Edge handling: 'none' (periodic), 'mirror' (mirror-symmetric extension) or 'zero' (zero padding)
+    :param workers: Number of threads used by the FFTs (None for the scipy.fft default)
+    """
+
+    def __init__(self, dpcx: np.ndarray, dpcy: np.ndarray, *, rotation: float = 0, pad: str = 'none', workers: typing.Optional[int] = None):
+        if pad not in ('none', 'mirror', 'zero'): raise ValueError('Unknown padding ' + repr(pad))
+        self.shape = dpcx.shape[-2:]
+        self.rotation = rotation
+        self.pad = pad
+        self.workers = workers
+        c, s = _Rotation(rotation, dpcx.ndim)
+        rdpcx = dpcx * c + dpcy * s
+        rdpcy = -dpcx * s + dpcy * c
+        if pad == 'mirror':
+            # Mirroring the potential flips the sign of the gradient component normal to each mirror
+            rdpcx = np.block([[rdpcx, -rdpcx[..., ::-1]], [rdpcx[..., ::-1, :], -rdpcx[..., ::-1, ::-1]]])
+            rdpcy = np.block([[rdpcy, rdpcy[..., ::-1]], [-rdpcy[..., ::-1, :], -rdpcy[..., ::-1, ::-1]]])
+        elif pad == 'zero':
+            edges = ((0, 0),) * (rdpcx.ndim - 2) + ((0, self.shape[0]), (0, self.shape[1]))
+            rdpcx = np.pad(rdpcx, edges)
+            rdpcy = np.pad(rdpcy, edges)
+        self.padded = rdpcx.shape[-2:]
+        import scipy.fft
+        self.fCX = scipy.fft.rfft2(rdpcx, workers=workers)
+        self.fCY = scipy.fft.rfft2(rdpcy, workers=workers)
+        PY, PX = self.padded
+        centered = pad != 'none'
+        kx = _FrequencyGrid(PX, self.shape[1], centered)
+        ky = _FrequencyGrid(PY, self.shape[0], centered)
+        # Frequencies at -k, so the filter can be made Hermitian and the result computed with real FFTs
+        self.kx, self.kxn = kx[:PX // 2 + 1], kx[(-np.arange(PX)) % PX][:PX // 2 + 1]
+        self.ky, self.kyn = ky[:, None], ky[(-np.arange(PY)) % PY][:, None]
+
+    @_Instrumented
+    def solve(self, hpass: float = 0, lpass: float = 0) -> np.ndarray:
+        """Potential for one set of filter constants
+
+        :param hpass: Optional constant to provide variable high-pass filtering
+        :param lpass: Optional constant to provide variable low-pass filtering
+        :return: The potential as a 2D numpy array (or stack)
+        """
+        def Filter(kx, ky):
+            k2 = kx ** 2 + ky ** 2
+            D = hpass + k2 + lpass * k2 ** 2
+            zero = D == 0
+            D = np.where(zero, 1, D)
+            return np.where(zero, 0, kx / D), np.where(zero, 0, ky / D)
+        HX, HY = Filter(self.kx, self.ky)
+        HXn, HYn = Filter(self.kxn, self.kyn)
+        # The real part of the complex inverse gradient equals the inverse of the Hermitian part of the filter
+        fK = (self.fCX * (HX - HXn) + self.fCY * (HY - HYn)) / (4j * np.pi)
+        import scipy.fft
+        V = scipy.fft.irfft2(fK, s=self.padded, workers=self.workers)
+        return V[..., :self.shape[0], :self.shape[1]]
+
+
+@_Instrumented
+def GetPotential(dpcx: np.ndarray, dpcy: np.ndarray, *, rotation: float = 0, hpass: float = 0, lpass: float = 0, pad: str = 'none', workers: typing.Optional[int] = None) -> np.ndarray:
     """Convert X and Y Shifts (E-Field Vector) Into Atomic Potential By Inverse Gradient
 
     Note: This method is vulnerable to edge induced artifacts that a small degree of high-pass filtering
-    can clear up without significantly affecting the atomic-level contrast
+    can clear up without significantly affecting the atomic-level contrast, or that mirror padding avoids
 
-    :param dpcx: X-Component of DPC Data (2D numpy array)
-    :param dpcy: Y-Component of DPC Data (2D numpy array)
-    :param rotation: Optional rotation radians
+    :param dpcx: X-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param dpcy: Y-Component of DPC Data (2D numpy array, or stack of 2D maps)
+    :param rotation: Optional rotation radians, one per map of a stack or shared by all
     :param hpass: Optional constant to provide variable high-pass filtering
     :param lpass: Optional constant to provide variable low-pass filtering
-    :return: The potential as a 2D numpy array
-    """
-
-    rdpcx = dpcx * np.cos(rotation) + dpcy * np.sin(rotation)
-    rdpcy = -dpcx * np.sin(rotation) + dpcy * np.cos(rotation)
-    fCX = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(rdpcx)))
-    fCY = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(rdpcy)))
-    KX = fCX.shape[1]
-    KY = fCY.shape[0]
-    kxran = np.linspace(-1, 1, KX, endpoint=True)
-    kyran = np.linspace(-1, 1, KY, endpoint=True)
-    kx, ky = np.meshgrid(kxran, kyran)
-    fCKX = fCX * kx
-    fCKY = fCY * ky
-    fnum = (fCKX + fCKY)
-    fdenom = np.pi * 2 * (0 + 1j) * (hpass + (kx ** 2 + ky ** 2) + lpass * (kx ** 2 + ky ** 2) ** 2)
-    fK = np.divide(fnum, fdenom)
-
-    return np.real(np.fft.ifftshift(np.fft.ifft2(np.fft.ifftshift(fK))))
+    :param pad: Edge handling: 'none' (periodic), 'mirror' (mirror-symmetric extension) or 'zero' (zero padding)
+    :param workers: Number of threads used by the FFTs (None for the scipy.fft default)
+    :return: The potential as a 2D numpy array (or stack)
+    """
+    return PotentialSolver(dpcx, dpcy, rotation=rotation, pad=pad, workers=workers).solve(hpass, lpass)
@@ -0,0 +1,186 @@
+"""Lazy, memoized graph of DPC results
+
+Every node of a Pipeline is computed from the values of other nodes and a set of named parameters,
+and is only recomputed when one of them changed since its value was stored. Editing the rotation
+therefore redoes the rotated maps, charge density, fields and potential from the stored CoM shifts
+without reading the 4D Dataset again, and editing the potential filters only redoes the inverse FFT.
+"""
+import collections
+import functools
+import itertools
+import threading
+import typing
+import numpy as np
+
+from getdpc import Cache, GetDPC
+
+
+Keyed = collections.namedtuple('Keyed', ['key', 'value'])
+Keyed.__doc__ = """Parameter value compared by key, e.g. a 4D Dataset by the identity and modification time of its source
+
+Nodes receive the value. Setting a Keyed parameter to an equal key only replaces the value, so
+Pipeline.release can drop a large array without making the results computed from it out of date.
+"""
+
+
+def _Same(a, b) -> bool:
+    """Parameters are unchanged if they are the same object, Keyed with equal keys, views of the same array buffer, or equal"""
+    if a is b: return True
+    if isinstance(a, Keyed) or isinstance(b, Keyed):
+        return isinstance(a, Keyed) and isinstance(b, Keyed) and _Same(a.key, b.key)
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if not (isinstance(a, np.ndarray) and isinstance(b, np.ndarray)): return False
+        return a.shape == b.shape and a.dtype == b.dtype and a.strides == b.strides and a.__array_interface__['data'][0] == b.__array_interface__['data'][0]
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        return False
+
+
+class Pipeline:
+    """Lazy graph of named results that tracks the parameters and results each one depends on
+
+    :param params: Initial parameter values
+    """
+
+    Node = collections.namedtuple('Node', ['function', 'inputs', 'params', 'progress'])
+
+    def __init__(self, **params):
+        self.nodes = collections.OrderedDict()
+        self.params = {}
+        self.versions = {}
+        self.cache = {}
+        # Versions of parameters and stored values are drawn from one counter and never reused, so a
+        # value recomputed after invalidate or put can never match the key of a stale dependent
+        self.counter = itertools.count(1)
+        self.lock = threading.RLock()
+        self.set(**params)
+
+    def add(self, name: str, function: typing.Callable, inputs: typing.Sequence[str] = (), params: typing.Sequence[str] = (), progress: bool = False):
+        """Add a node computed as function(*input values, **parameters)
+
+        :param name: Name of the node
+        :param function: Computes the value of the node
+        :param inputs: Names of the nodes whose values are passed positionally
+        :param params: Names of the parameters passed as keywords
+        :param progress: Also pass the progress callback of get to function (bool)
+        """
+        for node in inputs:
+            if node not in self.nodes: raise KeyError('Unknown input node ' + repr(node))
+        self.nodes[name] = self.Node(function, tuple(inputs), tuple(params), progress)
+        self.cache.pop(name, None)
+
+    def set(self, **params) -> typing.List[str]:
+        """Change parameters, the nodes depending on changed ones are recomputed when next requested
+
+        :return: names of the nodes whose values became out of date
+        """
+        with self.lock:
+            changed = [key for key, value in params.items() if key not in self.params or not _Same(self.params[key], value)]
+            for key in changed: self.versions[key] = next(self.counter)
+            self.params.update(params)
+            return [name for name in self.nodes if name in self.cache and not self.valid(name)]
+
+    def _key(self, name: str) -> typing.Tuple:
+        node = self.nodes[name]
+        missing = [key for key in node.params if key not in self.params]
+        if missing: raise KeyError('Node ' + repr(name) + ' needs the parameters ' + ', '.join(missing))
+        return tuple(self.versions[key] for key in node.params) + tuple(self.cache[n][2] if n in self.cache else None for n in node.inputs)
+
+    def valid(self, name: str) -> bool:
+        """True if the stored value of the node and of everything it depends on is up to date"""
+        with self.lock:
+            if name not in self.cache: return False
+            node = self.nodes[name]
+            if not all(self.valid(n) for n in node.inputs): return False
+            try:
+                return self.cache[name][0] == self._key(name)
+            except KeyError:
+                return False
+
+    def get(self, name: str, progress: typing.Optional[GetDPC.ProgressCallback] = None):
+        """Value of a node, computing it and any out of date node it depends on first"""
+        node = self.nodes[name]
+        values = [self.get(n, progress) for n in node.inputs]
+        with self.lock:
+            if self.valid(name): return self.cache[name][1]
+            key = self._key(name)
+            kwargs = {key: self.params[key].value if isinstance(self.params[key], Keyed) else self.params[key] for key in node.params}
+        if node.progress: kwargs['progress'] = progress
+        value = node.function(*values, **kwargs)
+        with self.lock:
+            # Parameters edited while computing change the key, so the value is recomputed on the next get
+            self.cache[name] = (key, value, next(self.counter))
+        return value
+
+    __getitem__ = get
+
+    def put(self, name: str, value):
+        """Store a value computed elsewhere for a node, e.g. CoM shifts from a live acquisition"""
+        with self.lock:
+            self.cache[name] = (self._key(name), value, next(self.counter))
+
+    def release(self, *names: str):
+        """Drop the values of Keyed parameters but keep their keys, the results computed from them stay valid"""
+        with self.lock:
+            for name in names:
+                if isinstance(self.params.get(name), Keyed): self.params[name] = Keyed(self.params[name].key, None)
+
+    def invalidate(self, name: typing.Optional[str] = None):
+        """Forget the value of a node (or of all nodes), its dependents follow automatically"""
+        with self.lock:
+            if name is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(name, None)
+
+
+def _Rotate(com: typing.Tuple[np.ndarray, np.ndarray], rotation: typing.Union[float, np.ndarray]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    dpcx, dpcy = com
+    c, s = GetDPC._Rotation(rotation, dpcx.ndim)
+    return dpcx * c - dpcy * s, dpcx * s + dpcy * c
+
+
+def _Calibration(dat4d: GetDPC.Dataset4D, conv: float, t: float, track: typing.Optional[float], call: typing.Callable, progress: typing.Optional[GetDPC.ProgressCallback] = None) -> typing.Tuple:
+    if isinstance(dat4d, np.ndarray) and dat4d.ndim == 5: return call(GetDPC.CalibrateSeries, dat4d, conv, t, track=track, progress=progress)
+    return call(GetDPC.CalibrateRonchigram, dat4d, conv, t, progress=progress)
+
+
+def _Detectors(dat4d: GetDPC.Dataset4D, RCX: float, RCY: float, RCal: float, RI: float, RO: float, centers: typing.Optional[np.ndarray], call: typing.Callable, progress: typing.Optional[GetDPC.ProgressCallback] = None) -> typing.Tuple:
+    if isinstance(dat4d, np.ndarray) and dat4d.ndim == 5: return call(GetDPC.GetSeriesDetectors, dat4d, RCX, RCY, RCal, [(RI, RO)], centers=centers, progress=progress)[0]
+    return call(GetDPC.GetVirtualDetectors, dat4d, RCX, RCY, RCal, [(RI, RO)], progress=progress)[0]
+
+
+def DPCPipeline(*, cache: typing.Optional[Cache.ResultCache] = None, **params) -> Pipeline:
+    """Pipeline of a complete DPC analysis
+
+    Parameters: dat4d, conv, t, track (calibration); RCX, RCY, RCal, RI, RO, centers (detector);
+    rotation; hpass, lpass, pad (potential). A 5D dat4d is processed as a series, all results are
+    then stacks with one map per frame. Give dat4d as Keyed(source, data) to compare it by source
+    rather than by buffer, and release it between computations. Nodes:
+
+    - calibration: CalibrateRonchigram(dat4d, conv, t), or CalibrateSeries(dat4d, conv, t, track=track)
+    - detectors: (detector image, iCoM X, iCoM Y) of GetVirtualDetectors (or GetSeriesDetectors with centers), a single pass over dat4d
+    - detector, com: the detector image and the unrotated (iCoM X, iCoM Y) of that pass
+    - auto_rotation: GetPLRotation of com
+    - rotated: com rotated by rotation
+    - charge, fields: GetChargeDensity and GetElectricFields of com with rotation
+    - solver, potential: PotentialSolver of com with rotation and pad, solved with hpass and lpass
+
+    :param cache: Load calibration and detectors from this ResultCache when they were computed before
+    :param params: Initial parameter values
+    :return: Pipeline, get a node with pipeline.get(name, progress)
+    """
+    call = cache.call if cache is not None else lambda function, *args, **kwargs: function(*args, **kwargs)
+    pipeline = Pipeline(**dict({'track': None, 'centers': None}, **params))
+    pipeline.add('calibration', functools.partial(_Calibration, call=call), params=('dat4d', 'conv', 't', 'track'), progress=True)
+    pipeline.add('detectors', functools.partial(_Detectors, call=call), params=('dat4d', 'RCX', 'RCY', 'RCal', 'RI', 'RO', 'centers'), progress=True)
+    pipeline.add('detector', lambda detectors: detectors[0], inputs=('detectors',))
+    pipeline.add('com', lambda detectors: (detectors[1], detectors[2]), inputs=('detectors',))
+    pipeline.add('auto_rotation', lambda com: GetDPC.GetPLRotation(*com), inputs=('com',))
+    pipeline.add('rotated', _Rotate, inputs=('com',), params=('rotation',))
+    pipeline.add('charge', lambda com, rotation: GetDPC.GetChargeDensity(*com, rotation=rotation), inputs=('com',), params=('rotation',))
+    pipeline.add('fields', lambda com, rotation: GetDPC.GetElectricFields(*com, rotation=rotation, dtype=np.uint8), inputs=('com',), params=('rotation',))
+    pipeline.add('solver', lambda com, rotation, pad: GetDPC.PotentialSolver(*com, rotation=rotation, pad=pad), inputs=('com',), params=('rotation', 'pad'))
+    pipeline.add('potential', lambda solver, hpass, lpass: solver.solve(hpass, lpass), inputs=('solver',), params=('hpass', 'lpass'))
+    return pipeline
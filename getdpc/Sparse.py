@@ -0,0 +1,220 @@
+"""Sparse representation of electron-counted 4D Datasets
+
+Low-dose Ronchigrams from counting detectors are mostly zero. Sparse4D keeps only the hit pixels of
+every frame in CSR layout (frame pointers, flattened pixel indices and counts), and the reductions
+here work on the hits directly, so their cost scales with the number of electrons instead of the
+number of detector pixels. Results match those of getdpc.GetDPC on the dense data.
+"""
+import typing
+import numpy as np
+
+from getdpc import GetDPC
+
+# Number of hits weighted at once by the reductions
+EVENT_BLOCK = 1 << 22
+
+
+class Sparse4D:
+    """Hit pixels of every Ronchigram of a 4D Dataset in CSR layout
+
+    Frames are numbered in scan order, frame scan y * SX + scan x. The hits of frame f are
+    indices[indptr[f]:indptr[f + 1]] (flattened Ronchigram pixels) with counts at the same positions.
+
+    :param shape: Shape of the dense 4D Dataset (SY, SX, NY, NX)
+    :param indptr: Offsets of the hits of every frame, SY * SX + 1 values
+    :param indices: Flattened Ronchigram pixel of every hit
+    :param counts: Counts of every hit
+    """
+
+    def __init__(self, shape: typing.Tuple[int, int, int, int], indptr: np.ndarray, indices: np.ndarray, counts: np.ndarray):
+        self.shape = tuple(int(n) for n in shape)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.counts = np.asarray(counts)
+        if len(self.shape) != 4: raise ValueError('A 4D shape is needed, not ' + str(self.shape))
+        if self.indptr.shape != (self.frames + 1,): raise ValueError('indptr needs ' + str(self.frames + 1) + ' values')
+        if self.indices.shape != self.counts.shape or self.indices.size != self.indptr[-1]: raise ValueError('indices and counts need one value per hit')
+
+    @property
+    def frames(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nnz(self) -> int:
+        return int(self.indices.size)
+
+    @property
+    def density(self) -> float:
+        """Fraction of nonzero pixels"""
+        return self.nnz / max(self.frames * self.shape[2] * self.shape[3], 1)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.counts.nbytes
+
+    def frame_ids(self, f0: int = 0, f1: typing.Optional[int] = None) -> np.ndarray:
+        """Frame of every hit of frames f0:f1, counted from f0"""
+        f1 = self.frames if f1 is None else f1
+        return np.repeat(np.arange(f1 - f0), np.diff(self.indptr[f0:f1 + 1]))
+
+    def frame(self, y: int, x: int) -> np.ndarray:
+        """Dense Ronchigram at scan position (y, x)"""
+        f = y * self.shape[1] + x
+        R = np.zeros(self.shape[2] * self.shape[3], dtype=self.counts.dtype)
+        R[self.indices[self.indptr[f]:self.indptr[f + 1]]] = self.counts[self.indptr[f]:self.indptr[f + 1]]
+        return R.reshape(self.shape[2:])
+
+    def todense(self) -> np.ndarray:
+        dense = np.zeros((self.frames, self.shape[2] * self.shape[3]), dtype=self.counts.dtype)
+        dense[self.frame_ids(), self.indices] = self.counts
+        return dense.reshape(self.shape)
+
+    def save(self, path: str):
+        """Write to a .npz file"""
+        np.savez(path, shape=np.array(self.shape), indptr=self.indptr, indices=self.indices, counts=self.counts)
+
+    @classmethod
+    def load(cls, path: str) -> 'Sparse4D':
+        with np.load(path) as f: return cls(tuple(f['shape']), f['indptr'], f['indices'], f['counts'])
+
+    @classmethod
+    def from_events(cls, shape: typing.Tuple[int, int, int, int], frame: np.ndarray, pixel: np.ndarray, counts: typing.Optional[np.ndarray] = None, dtype: np.dtype = np.uint16) -> 'Sparse4D':
+        """Build from an unordered list of detected electrons, repeated hits of a pixel are summed
+
+        :param shape: Shape of the dense 4D Dataset (SY, SX, NY, NX)
+        :param frame: Frame (scan y * SX + scan x) of every event
+        :param pixel: Flattened Ronchigram pixel (y * NX + x) of every event
+        :param counts: Counts of every event (default: 1)
+        :param dtype: Type of the counts
+        """
+        frame, pixel = np.asarray(frame, dtype=np.int64), np.asarray(pixel, dtype=np.int64)
+        key = frame * (shape[2] * shape[3]) + pixel
+        unique, inverse = np.unique(key, return_inverse=True)
+        summed = np.bincount(inverse, weights=counts, minlength=unique.size).astype(dtype)
+        frames, indices = np.divmod(unique, shape[2] * shape[3])
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(frames, minlength=shape[0] * shape[1]))])
+        return cls(shape, indptr, indices, summed)
+
+
+def _SparsifyRowBlock(block: np.ndarray, threshold: float) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rows, SX, NY, NX = block.shape
+    flat = block.reshape(rows * SX, NY * NX)
+    frame, pixel = np.nonzero(flat > threshold)
+    return np.bincount(frame, minlength=rows * SX), pixel.astype(np.int32), flat[frame, pixel]
+
+
+@GetDPC._Instrumented
+def FromDense(dat4d: GetDPC.Dataset4D, *, threshold: float = 0, chunk_rows: typing.Optional[int] = None, workers: typing.Optional[int] = 1, executor: str = 'threads', progress: typing.Optional[GetDPC.ProgressCallback] = None) -> Sparse4D:
+    """Keep the pixels of a dense 4D Dataset above a threshold
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap, Chunked4D or path to .npy or chunked directory)
+    :param threshold: Pixels with counts at or below it are dropped (0 keeps all nonzero pixels)
+    :param chunk_rows: Number of scan rows read per block (default: sized automatically)
+    :param workers: Number of blocks converted in parallel (None for all cores)
+    :param executor: Parallelize over 'threads' or 'processes'
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: Sparse4D with the counts in the type of the data
+    """
+    dat4d = GetDPC._Open4D(dat4d)
+    blocks = GetDPC._MapRowBlocks(dat4d, _SparsifyRowBlock, (threshold,), chunk_rows, workers, executor, progress)
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate([block[0] for block in blocks]))])
+    return Sparse4D(dat4d.shape, indptr, np.concatenate([block[1] for block in blocks]), np.concatenate([block[2] for block in blocks]))
+
+
+@GetDPC._Instrumented
+def GetMeanRonchigram(sparse: Sparse4D, *, dtype: np.dtype = np.float32) -> np.ndarray:
+    """Average Ronchigram from the hits of all frames
+
+    :param sparse: Sparse 4D Dataset
+    :param dtype: Type of the mean Ronchigram
+    :return: mean Ronchigram as 2D ndarray
+    """
+    NY, NX = sparse.shape[2:]
+    GetDPC._CountRead(sparse.frames, sparse.indices.nbytes + sparse.counts.nbytes)
+    R = np.bincount(sparse.indices, weights=sparse.counts, minlength=NY * NX) / sparse.frames
+    return R.reshape(NY, NX).astype(dtype, copy=False)
+
+
+@GetDPC._Instrumented
+def CalibrateRonchigram(sparse: Sparse4D, conv: float = 32, t: float = 0.3, *, fit: str = 'centroid', dtype: np.dtype = np.float32) -> typing.Tuple:
+    """Find true center of Ronchigram, and pixels/mrad calibration, see getdpc.GetDPC.CalibrateRonchigram
+
+    :param sparse: Sparse 4D Dataset
+    :param conv: Convergence Angle of Electron Probe in mrad
+    :param t: Threshhold for BF Disk (fraction of 1)
+    :param fit: 'centroid' of the thresholded BF disk, or sub-pixel 'circle' fit to its edge
+    :param dtype: Type of the mean Ronchigram
+    :return: center, calibrations
+    """
+    R = GetMeanRonchigram(sparse, dtype=np.float64)
+    rcx, rcy, pixcal, BFdisk, absct, edge = GetDPC._CalibrateMean(R, conv, t, fit)
+    return R.astype(dtype, copy=False), rcx, rcy, pixcal, BFdisk, absct, edge
+
+
+def _DenseWeights(plan: GetDPC.DetectorPlan, dtype: np.dtype) -> np.ndarray:
+    """Weights of the plan for every Ronchigram pixel, so hits can index them directly"""
+    weights = plan.typed_weights(dtype)
+    if plan.idx is None: return weights
+    dense = np.zeros((plan.shape[0] * plan.shape[1], plan.channels), dtype=dtype)
+    dense[plan.idx] = weights
+    return dense
+
+
+def _ReduceHits(sparse: Sparse4D, plan: GetDPC.DetectorPlan, dtype: np.dtype, accum: np.dtype) -> np.ndarray:
+    """Sum the detector weights of all hits per frame, EVENT_BLOCK hits at a time"""
+    plan.check(sparse.shape)
+    GetDPC._CountRead(sparse.frames, sparse.nbytes)
+    weights = _DenseWeights(plan, accum)
+    out = np.zeros((sparse.frames, plan.channels), dtype=np.float64)
+    f0 = 0
+    while f0 < sparse.frames:
+        # Whole frames up to EVENT_BLOCK hits, at least one frame
+        f1 = max(f0 + 1, int(np.searchsorted(sparse.indptr, sparse.indptr[f0] + EVENT_BLOCK, side='right')) - 1)
+        f1 = min(f1, sparse.frames)
+        h0, h1 = sparse.indptr[f0], sparse.indptr[f1]
+        frame = sparse.frame_ids(f0, f1)
+        hits = weights[sparse.indices[h0:h1]] * sparse.counts[h0:h1, None].astype(accum, copy=False)
+        for c in range(plan.channels): out[f0:f1, c] = np.bincount(frame, weights=hits[:, c], minlength=f1 - f0)
+        f0 = f1
+    return out.reshape(sparse.shape[:2] + (plan.channels,)).astype(dtype, copy=False)
+
+
+@GetDPC._Instrumented
+def GetVirtualDetectors(sparse: Sparse4D, RCX: float, RCY: float, RCal: float, radii: typing.Sequence[GetDPC.DetectorSpec] = ((0, 32),), *, com: bool = True, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, plan: typing.Optional[GetDPC.DetectorPlan] = None, descan: typing.Optional[GetDPC.DescanMap] = None) -> typing.List:
+    """Reconstruct detector images and CoM shifts for several annular detectors from the hits
+
+    :param sparse: Sparse 4D Dataset
+    :param RCX: X Center of the Ronchigram (pixels)
+    :param RCY: Y Center of the Ronchigram (pixels)
+    :param RCal: Calibration of the Ronchigram (pixels/mrad)
+    :param radii: Sequence of (Inner, Outer) radii in mrad, or (Inner, Outer, Start, End) for segments with angles in radians, one per detector
+    :param com: Also return the CoM shifts measured within every detector (bool)
+    :param dtype: Type of the returned maps
+    :param accum: Precision of the weights (np.float32 or np.float64), frames are summed in float64
+    :param plan: Precompiled detector geometry, replaces RCX, RCY, RCal, radii and com
+    :param descan: Measure the CoM shifts from the BF disk center of this DescanMap instead of RCX, RCY
+    :return: list with one (detector image, iCoM X, iCoM Y) tuple per detector, or one detector image per detector if com is False
+    """
+    if plan is None: plan = GetDPC.GetDetectorPlan(sparse.shape, RCX, RCY, RCal, radii, com)
+    out = _ReduceHits(sparse, plan, dtype, accum)
+    if descan is not None: descan.correct(out, plan)
+    return plan.unpack(out)
+
+
+def GetDetectorImage(sparse: Sparse4D, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32, *, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, plan: typing.Optional[GetDPC.DetectorPlan] = None) -> np.ndarray:
+    """Reconstruct a detector image from the hits, see GetVirtualDetectors
+
+    :return detector image as ndarray
+    """
+    detector = GetVirtualDetectors(sparse, RCX, RCY, RCal, [(RI, RO)], dtype=dtype, accum=accum, plan=plan)[0]
+    return detector[0] if isinstance(detector, tuple) else detector
+
+
+def GetiCoM(sparse: Sparse4D, RCX: float, RCY: float, RCal: float, RI: float = 0, RO: float = 32, *, dtype: np.dtype = np.float32, accum: np.dtype = np.float32, plan: typing.Optional[GetDPC.DetectorPlan] = None, descan: typing.Optional[GetDPC.DescanMap] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Get Ronchigram Center of Mass Shifts from the hits, see GetVirtualDetectors
+
+    :return iCoM as ndarray
+    """
+    if plan is not None and not plan.com: raise ValueError('GetiCoM needs a detector plan compiled with com')
+    detector = GetVirtualDetectors(sparse, RCX, RCY, RCal, [(RI, RO)], dtype=dtype, accum=accum, plan=plan, descan=descan)[0]
+    return detector[1], detector[2]
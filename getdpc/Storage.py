@@ -0,0 +1,220 @@
+"""Compressed, chunked storage of 4D Datasets
+
+A 4D Dataset is converted once into a directory holding one compressed file per block of scan rows,
+the metadata and the mean Ronchigram. Chunked4D opens such a directory and behaves like a read-only
+array along the scan rows, so every GetDPC reduction streams from it and decompresses the blocks in
+parallel. Low-dose counting data are mostly zeros and compress several-fold.
+"""
+import bz2
+import collections
+import concurrent.futures
+import json
+import lzma
+import os
+import threading
+import typing
+import zlib
+import numpy as np
+
+from getdpc import GetDPC
+
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+    'none': (lambda data, level: bytes(data), bytes),
+}
+
+META = 'meta.json'
+MEAN = 'mean.npy'
+
+
+def _ChunkName(i: int) -> str:
+    return 'chunk' + format(i, '05d') + '.bin'
+
+
+def _Shuffle(block: np.ndarray) -> bytes:
+    """Group the bytes of all values by significance, so the mostly zero high bytes compress well"""
+    return np.ascontiguousarray(block).view(np.uint8).reshape(-1, block.dtype.itemsize).T.tobytes()
+
+
+def _Unshuffle(data: bytes, dtype: np.dtype, shape: typing.Tuple[int, ...]) -> np.ndarray:
+    return np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+
+def IsChunked4D(path: typing.Union[str, os.PathLike]) -> bool:
+    """True if path is a directory written by Convert4D"""
+    return os.path.isfile(os.path.join(path, META))
+
+
+class Chunked4D:
+    """Read-only 4D Dataset stored as compressed blocks of scan rows
+
+    Indexing along the scan rows (an int or a slice with step 1, optionally followed by further
+    indices) decompresses only the blocks involved. The most recently used blocks are kept, so
+    reading neighbouring rows one at a time does not decompress a block again.
+
+    :param path: Directory written by Convert4D
+    :param workers: Number of blocks decompressed in parallel when an index spans several blocks
+    :param cache: Number of decompressed blocks kept in memory
+    """
+
+    def __init__(self, path: typing.Union[str, os.PathLike], *, workers: typing.Optional[int] = None, cache: int = 2):
+        self.path = os.fspath(path)
+        with open(os.path.join(self.path, META)) as f: meta = json.load(f)
+        if meta.get('format') != 'getdpc-chunked4d': raise ValueError(self.path + ' is not a chunked 4D Dataset')
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunk_rows = int(meta['chunk_rows'])
+        self.codec = meta['codec']
+        self.shuffle = bool(meta['shuffle'])
+        self.sizes = list(meta['sizes'])
+        self.metadata = meta.get('metadata', {})
+        self.workers = workers if workers is not None else min(4, os.cpu_count() or 1)
+        self._decompress = CODECS[self.codec][1]
+        self._cache = collections.OrderedDict()
+        self._cachesize = cache
+        self._lock = threading.Lock()
+        self._mean = None
+
+    ndim = 4
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __repr__(self) -> str:
+        return 'Chunked4D(' + repr(self.path) + ', shape=' + str(self.shape) + ', dtype=' + self.dtype.name + ')'
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.dtype.itemsize
+
+    @property
+    def stored_bytes(self) -> int:
+        return int(sum(self.sizes))
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.nbytes / max(self.stored_bytes, 1)
+
+    @property
+    def mean_ronchigram(self) -> np.ndarray:
+        """Mean Ronchigram stored at conversion (float64)"""
+        if self._mean is None:
+            self._mean = np.load(os.path.join(self.path, MEAN))
+            self._mean.flags.writeable = False
+        return self._mean
+
+    def chunk(self, i: int) -> np.ndarray:
+        """Decompressed block i of scan rows"""
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+        r0 = i * self.chunk_rows
+        shape = (min(self.chunk_rows, self.shape[0] - r0),) + self.shape[1:]
+        with open(os.path.join(self.path, _ChunkName(i)), 'rb') as f: data = self._decompress(f.read())
+        block = _Unshuffle(data, self.dtype, shape) if self.shuffle else np.frombuffer(data, self.dtype).reshape(shape)
+        block.flags.writeable = False
+        with self._lock:
+            self._cache[i] = block
+            while len(self._cache) > self._cachesize: self._cache.popitem(last=False)
+        return block
+
+    def rows(self, r0: int, r1: int) -> np.ndarray:
+        """Scan rows r0:r1 as ndarray"""
+        r0, r1 = max(r0, 0), min(r1, self.shape[0])
+        if r1 <= r0: return np.empty((0,) + self.shape[1:], self.dtype)
+        first, last = r0 // self.chunk_rows, (r1 - 1) // self.chunk_rows
+        indices = range(first, last + 1)
+        if len(indices) > 1 and self.workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(min(self.workers, len(indices))) as pool: blocks = list(pool.map(self.chunk, indices))
+        else:
+            blocks = [self.chunk(i) for i in indices]
+        offset = first * self.chunk_rows
+        if len(blocks) == 1: return blocks[0][r0 - offset:r1 - offset]
+        return np.concatenate(blocks, axis=0)[r0 - offset:r1 - offset]
+
+    def __getitem__(self, key) -> np.ndarray:
+        rest = ()
+        if isinstance(key, tuple): key, rest = key[0], key[1:]
+        if isinstance(key, slice):
+            r0, r1, step = key.indices(self.shape[0])
+            block = self.rows(r0, r1)[::step] if step > 0 else self.rows(r1 + 1, r0 + 1)[::step]
+            # The scan-row axis is kept, further indices apply to the axes after it
+            return block[(slice(None),) + rest] if rest else block
+        elif isinstance(key, (int, np.integer)):
+            if key < 0: key += self.shape[0]
+            if not 0 <= key < self.shape[0]: raise IndexError('Scan row ' + str(key) + ' is out of range')
+            block = self.rows(key, key + 1)[0]
+        else:
+            raise TypeError('Chunked4D is indexed by scan rows (int or slice), not ' + type(key).__name__)
+        return block[rest] if rest else block
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        data = self.rows(0, self.shape[0])
+        return data if dtype is None else data.astype(dtype)
+
+    def update_metadata(self, **metadata):
+        """Store further metadata, e.g. the calibration, next to the data"""
+        self.metadata.update(metadata)
+        path = os.path.join(self.path, META)
+        with open(path) as f: meta = json.load(f)
+        meta['metadata'] = self.metadata
+        with open(path + '.tmp', 'w') as f: json.dump(meta, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+@GetDPC._Instrumented
+def Convert4D(dat4d: GetDPC.Dataset4D, path: typing.Union[str, os.PathLike], *, chunk_rows: typing.Optional[int] = None, codec: str = 'zlib', level: int = 1, shuffle: bool = True, workers: typing.Optional[int] = None, metadata: typing.Optional[typing.Dict] = None, progress: typing.Optional[GetDPC.ProgressCallback] = None) -> Chunked4D:
+    """Convert a 4D Dataset into a compressed, chunked directory
+
+    The mean Ronchigram is accumulated during the conversion, so a later calibration does not need
+    to read the data at all.
+
+    :param dat4d: 4D Dataset, 2-spatial, 2-diffraction dimensions (ndarray, memmap or path to .npy)
+    :param path: Directory to write, created if needed
+    :param chunk_rows: Number of scan rows per compressed block (default: sized automatically)
+    :param codec: 'zlib', 'lzma', 'bz2' or 'none'
+    :param level: Compression level, low levels are much faster and compress sparse data nearly as well
+    :param shuffle: Group the bytes by significance before compression (bool)
+    :param workers: Number of blocks compressed in parallel (None for all cores)
+    :param metadata: JSON-serializable metadata stored with the data
+    :param progress: Called as progress(blocks done, total blocks) after every block, raise from it to cancel
+    :return: the converted Chunked4D
+    """
+    if codec not in CODECS: raise ValueError('Unknown codec ' + repr(codec))
+    dat4d = GetDPC._Open4D(dat4d)
+    if dat4d.ndim != 4: raise ValueError('A 4D Dataset is needed, not ' + str(dat4d.ndim) + 'D')
+    path = os.fspath(path)
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, META)): os.remove(os.path.join(path, META))
+    chunk_rows = GetDPC._ChunkRows(dat4d.shape, chunk_rows)
+    compress = CODECS[codec][0]
+    starts = range(0, dat4d.shape[0], chunk_rows)
+
+    def Write(i):
+        block = np.asarray(dat4d[starts[i]:starts[i] + chunk_rows])
+        data = compress(_Shuffle(block) if shuffle else np.ascontiguousarray(block).tobytes(), level)
+        with open(os.path.join(path, _ChunkName(i)), 'wb') as f: f.write(data)
+        return len(data), np.sum(block, axis=(0, 1), dtype=np.float64)
+
+    if workers is None: workers = os.cpu_count() or 1
+    results = []
+    # zlib, lzma and bz2 release the GIL, so blocks are read and compressed by a thread pool
+    with concurrent.futures.ThreadPoolExecutor(max(1, min(workers, len(starts)))) as pool:
+        for result in pool.map(Write, range(len(starts))):
+            results.append(result)
+            rows = min(chunk_rows, dat4d.shape[0] - starts[len(results) - 1])
+            GetDPC._CountRead(rows * dat4d.shape[1], rows * int(np.prod(dat4d.shape[1:])) * dat4d.dtype.itemsize)
+            if progress is not None: progress(len(results), len(starts))
+    SY, SX = dat4d.shape[:2]
+    np.save(os.path.join(path, MEAN), np.sum([result[1] for result in results], axis=0) / (SY * SX))
+    meta = {'format': 'getdpc-chunked4d', 'version': 1, 'shape': list(dat4d.shape), 'dtype': dat4d.dtype.str, 'chunk_rows': chunk_rows,
+            'codec': codec, 'level': level, 'shuffle': bool(shuffle), 'sizes': [result[0] for result in results], 'metadata': metadata or {}}
+    with open(os.path.join(path, META), 'w') as f: json.dump(meta, f, indent=2)
+    return Chunked4D(path)
@@ -1,17 +1,20 @@
 # standard libraries
+import collections
+import functools
 import gettext
 import logging
 import numpy as np
-import scipy
 import threading
+import time
 
 # local libraries
+from getdpc import Cache
 from getdpc import GetDPC
+from getdpc import Pipeline
 
 # third party libraries
 from nion.data import Calibration
 from nion.data import DataAndMetadata
-from nion.data import xdata_1_0 as xd
 
 _ = gettext.gettext
 
@@ -28,6 +31,136 @@ class DPCExtension(object):
         self.__panel_ref.close()
         self.__panel_ref = None
 
+class JobCancelled(Exception):
+    pass
+
+class DPCJobQueue(object):
+    #Runs panel computations one at a time on a worker thread and shows their results on the UI thread
+    def __init__(self, queue_task):
+        self.queue_task = queue_task
+        self.status = None
+        self.instrument = False
+        self.reports = collections.deque(maxlen=20)
+        self.pending = collections.OrderedDict()
+        self.running = None
+        self.closed = False
+        self.cancelled = threading.Event()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name, compute, show=None):
+        #Repeated clicks replace the queued job of the same name, or restart it if it is already running
+        with self.condition:
+            self.pending[name] = (compute, show)
+            if self.running == name: self.cancelled.set()
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.pending.clear()
+            if self.running is not None: self.cancelled.set()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.cancelled.set()
+            self.condition.notify()
+
+    def progress(self, done, total):
+        #Called from the reductions after every chunk of scan rows
+        if self.cancelled.is_set(): raise JobCancelled()
+        self.report(str(self.running)+': '+str(int(100*done/max(total,1)))+'%')
+
+    def report(self, text):
+        if self.status is not None: self.queue_task(functools.partial(self.status, text))
+
+    def measure(self, name, compute):
+        #With instrumentation on, every job keeps a report of the GetDPC stages it ran
+        if not self.instrument:
+            compute(progress=self.progress)
+            return
+        start = time.perf_counter()
+        with GetDPC.Instrument(log=False) as report:
+            try:
+                compute(progress=self.progress)
+            finally:
+                job = {'job': name, 'seconds': time.perf_counter()-start, 'peak_rss_mb': GetDPC.GetPeakMemory()}
+                job.update(report.as_dict())
+                self.reports.append(job)
+                logging.info('%s: %.1f ms\n%s', name, job['seconds']*1000, report.summary())
+                print(name+': '+str(round(job['seconds']*1000,1))+' ms')
+                if report.stages: print(report.summary())
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed: self.condition.wait()
+                if self.closed: return
+                name, (compute, show) = self.pending.popitem(last=False)
+                self.running = name
+                self.cancelled.clear()
+            self.report(name+'...')
+            try:
+                self.measure(name, compute)
+            except JobCancelled:
+                print('Cancelled '+name)
+                self.report(name+': Cancelled')
+            except Exception as e:
+                logging.exception(name+' failed')
+                print(type(e).__name__+': '+str(e))
+                self.report(name+': Failed')
+            else:
+                if show is not None: self.queue_task(show)
+                self.report(name+': Done')
+            finally:
+                with self.condition: self.running = None
+
+class ResultSink(object):
+    #One data item per panel result: created once, found again by its uuid and updated from a preallocated buffer
+    def __init__(self, api):
+        self.api = api
+        self.uuid = None
+        self.buffer = None
+
+    @property
+    def created(self):
+        return self.uuid is not None
+
+    def item(self):
+        #None before the first result or after the data item was deleted in Swift
+        if self.uuid is None: return None
+        return self.api.library.get_data_item_by_uuid(self.uuid)
+
+    def buffer_like(self, shape, dtype):
+        #Reallocated only when the shape or type of the result changes
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if self.buffer is None or self.buffer.shape!=shape or self.buffer.dtype!=dtype: self.buffer = np.empty(shape, dtype)
+        return self.buffer
+
+    def sequence(self):
+        #Stacks of maps from a sequence of 4D-STEM Datasets, RGB maps are uint8 with 3 channels last
+        rgb = self.buffer.dtype==np.uint8 and self.buffer.shape[-1]==3
+        return self.buffer.ndim-rgb==3
+
+    def write(self, data=None, title=None):
+        #Copies data into the buffer (or shows the buffer as filled by the caller) and updates the data item in place
+        if data is not None: np.copyto(self.buffer_like(data.shape, data.dtype), data)
+        item = self.item()
+        xdata = DataAndMetadata.new_data_and_metadata(self.buffer, data_descriptor=DataAndMetadata.DataDescriptor(True, 0, 2)) if self.sequence() else None
+        if item is None:
+            if xdata is not None: item = self.api.library.create_data_item_from_data_and_metadata(xdata, title)
+            else: item = self.api.library.create_data_item_from_data(self.buffer, title)
+            self.uuid = item.uuid
+        elif xdata is not None:
+            item.set_data_and_metadata(xdata)
+            if title is not None and item.title!=title: item.title = title
+        else:
+            with self.api.library.data_ref_for_data_item(item) as data_ref: data_ref.data = self.buffer
+            if title is not None and item.title!=title: item.title = title
+        return item
+
 class GetDPCDelegate(object):
     def __init__(self,api):  
         self.api = api
@@ -41,6 +174,7 @@ class GetDPCDelegate(object):
         self.rcy = 0.
         self.hpass=0.
         self.lpass=0.
+        self.potpad='none'
         self.rotation=0.
         self.conv = 32.
         self.ri = 0.
@@ -49,11 +183,6 @@ class GetDPCDelegate(object):
         self.dpcro = self.ro
         self.pixcal = 1.
         self.centerfound = False
-        self.detimgenerated=False
-        self.dpccalculated = False
-        self.rhocalculated = False
-        self.fieldscalculated = False
-        self.vimcalculated = False
         self.dpcx = None
         self.dpcy = None
         self.RHO = None
@@ -62,15 +191,32 @@ class GetDPCDelegate(object):
         self.CLEG = None
         self.VIM = None
         self.dat4duuid = None
-        self.dpcxuuid = None
-        self.dpcyuuid = None
-        self.RHOuuid = None
-        self.EIMuuid = None
-        self.CIMuuid = None
-        self.CLEGuuid = None
-        self.VIMuuid = None
+        self.sinks = {}
+        self.document_window = None
+        self.jobs = None
+        self.DETIM = None
+        self.banktext = 'BF, ABF, LAADF, HAADF, Quadrants'
+        self.BANK = None
+        self.livepoll = 0.2
+        self.liveinterval = 1.0
+        self.livestop = None
+        self.livethread = None
+        self.preview = False
+        self.previewlevels = 2
+        self.pyramid = None
+        self.track = False
+        self.drift = None
+        #Calibrations, detector images and CoM shifts are kept on disk, so reopening a dataset loads them
+        try:
+            self.cache = Cache.ResultCache()
+        except OSError as e:
+            print('Not caching results: '+str(e))
+            self.cache = None
+        self.pipeline = Pipeline.DPCPipeline(cache=self.cache)
 
     def create_panel_widget(self, ui, document_window):#,document_controller):
+        self.document_window = document_window
+        if self.jobs is None: self.jobs = DPCJobQueue(document_window.queue_task)
 
         ##############################      
         ### Ronchigram Calibration ###
@@ -79,15 +225,20 @@ class GetDPCDelegate(object):
         ### Button and BF Disk Threshold ### 
         CalibrateRonchiRow = ui.create_row_widget()
         cal_button = ui.create_push_button_widget("Calibrate Ronchigram")
+        def calibrate():
+            def calibrated():
+                self.ShowCalibration()
+                rcxedit.text = round(self.rcx,1)
+                rcyedit.text = round(self.rcy,1)
+                pixcaledit.text = round(self.pixcal,1)
+            self.Submit4D('Calibrate Ronchigram', self.CalibrateRonchigram, calibrated)
         def calclicked():
             try:
                 self.dat4duuid=document_window.target_data_item.uuid
-                self.CalibrateRonchigram()
             except AttributeError:
                 print('AttributeError: Select the 4D-STEM Dataset')
-            rcxedit.text = round(self.rcx,1)
-            rcyedit.text = round(self.rcy,1)
-            pixcaledit.text = round(self.pixcal,1)
+                return
+            calibrate()
         cal_button.on_clicked = calclicked
         CalibrateRonchiRow.add(cal_button)
         CalibrateRonchiRow.add_spacing(6)
@@ -102,10 +253,38 @@ class GetDPCDelegate(object):
             except ValueError:
                 print('ValueError: Not Changing BF Limit')
                 ctedit.text = round(self.findct,2)
-            self.UpdateBFDisk()
+            if self.preview and self.dat4duuid is not None: calibrate()
+            else: self.UpdateBFDisk()
         ctedit.on_editing_finished = ct_editing_finished
         CalibrateRonchiRow.add(ctedit)
         CalibrateRonchiRow.add_spacing(8)
+
+        ### Preview on Binned Data, Full Resolution on Confirm ###
+        PreviewRow = ui.create_row_widget()
+        PreviewRow.add_spacing(8)
+        preview_checkbox = ui.create_check_box_widget("Preview (binned by "+str(2**self.previewlevels)+")")
+        def preview_changed(checked):
+            if self.preview!=checked: print(('Started' if checked else 'Stopped')+' Previewing on Binned Data')
+            self.preview=checked
+        preview_checkbox.on_checked_changed = preview_changed
+        PreviewRow.add(preview_checkbox)
+        PreviewRow.add_spacing(8)
+        fullres_button = ui.create_push_button_widget("Full Resolution")
+        def fullres_clicked():
+            preview_checkbox.checked = False
+            self.preview=False
+            if self.Sink('Detector Image').created: GetDI_clicked()
+            GetCOM_clicked()
+        fullres_button.on_clicked = fullres_clicked
+        PreviewRow.add(fullres_button)
+        PreviewRow.add_spacing(8)
+        track_checkbox = ui.create_check_box_widget("Track Drift (Sequences)")
+        def track_changed(checked):
+            if self.track!=checked: print(('Tracking' if checked else 'Not Tracking')+' the BF Disk Center across Sequence Frames')
+            self.track=checked
+        track_checkbox.on_checked_changed = track_changed
+        PreviewRow.add(track_checkbox)
+        PreviewRow.add_stretch()
       
         ### Center X and Y ###
         CalibratedCenterRow = ui.create_row_widget()
@@ -178,6 +357,7 @@ class GetDPCDelegate(object):
         ### Group and Display ###
         RonchigramCalibration = ui.create_column_widget()
         RonchigramCalibration.add(CalibrateRonchiRow)
+        RonchigramCalibration.add(PreviewRow)
         RonchigramCalibration.add(CalibratedCenterRow)
         RonchigramCalibration.add(CalibrationParamsRow)
 
@@ -199,6 +379,7 @@ class GetDPCDelegate(object):
             except ValueError:
                 print('ValueError: Not Changing Inner Radius')
                 riedit.text = round(self.ri,1)  
+            if self.preview: previewdetectors()
         riedit.on_editing_finished = ri_editing_finished
         SetRadiiRow.add(riedit)
         SetRadiiRow.add_spacing(8)
@@ -213,6 +394,7 @@ class GetDPCDelegate(object):
             except ValueError:
                 print('ValueError: Not Changing Outer Radius')
                 roedit.text = round(self.ro,1)  
+            if self.preview: previewdetectors()
         roedit.on_editing_finished = ro_editing_finished
         SetRadiiRow.add(roedit)
         SetRadiiRow.add_spacing(8)
@@ -221,24 +403,66 @@ class GetDPCDelegate(object):
         GetDIButtonRow = ui.create_row_widget()
         getdi_button = ui.create_push_button_widget("Get Detector Image")
         def GetDI_clicked():
-            self.GetDetectorImage()
+            self.Submit4D('Get Detector Image', self.GetDetectorImage, lambda: self.ShowDetectorImage(self.DETIM))
         getdi_button.on_clicked = GetDI_clicked
+        def previewdetectors():
+            #Radii changes redo the detector image and CoM shifts on the binned data right away
+            if self.dat4duuid is None: return
+            GetDI_clicked()
+            GetCOM_clicked()
         GetDIButtonRow.add(getdi_button)
 
+        ### Get Images for a Whole Bank of Detectors in One Pass ###
+        GetBankRow = ui.create_row_widget()
+        getbank_button = ui.create_push_button_widget("Get Detector Bank")
+        def GetBank_clicked():
+            self.Submit4D('Get Detector Bank', self.GetDetectorBank, self.ShowDetectorBank)
+        getbank_button.on_clicked = GetBank_clicked
+        GetBankRow.add(getbank_button)
+        GetBankRow.add_spacing(6)
+        bankedit = ui.create_line_edit_widget()
+        bankedit.text = self.banktext
+        def bank_editing_finished(text):
+            try:
+                self.ParseDetectorBank(text)
+                if self.banktext!=text: print('Set Detector Bank to '+text)
+                self.banktext=text
+            except ValueError as e:
+                print('ValueError: Not Changing Detector Bank ('+str(e)+')')
+                bankedit.text = self.banktext
+        bankedit.on_editing_finished = bank_editing_finished
+        GetBankRow.add(bankedit)
+        GetBankRow.add_spacing(8)
+
         ### Calculate Center of Mass Shifts
         GetCOMShiftRow = ui.create_row_widget()
         getcom_button = ui.create_push_button_widget("Get Center of Mass Shifts")
         def GetCOM_clicked():
-            self.GetICOM()
+            self.Submit4D('Get CoM Shifts', self.GetICOM, self.ShowCoM)
         getcom_button.on_clicked = GetCOM_clicked
         GetCOMShiftRow.add(getcom_button)
+        GetCOMShiftRow.add_spacing(6)
+        live_checkbox = ui.create_check_box_widget("Live")
+        def live_changed(checked):
+            if checked:
+                try:
+                    self.dat4duuid=document_window.target_data_item.uuid
+                except AttributeError:
+                    print('AttributeError: Select the 4D-STEM Dataset being acquired')
+                    live_checkbox.checked = False
+                    return
+                self.StartLiveCoM()
+            else: self.StopLiveCoM()
+        live_checkbox.on_checked_changed = live_changed
+        GetCOMShiftRow.add(live_checkbox)
         
         ### Calculate Rotation from PLs ### 
         CalculatePLRotationRow = ui.create_row_widget()
         rot_button = ui.create_push_button_widget("Get PL Rotation")
         def rotclicked():
-            self.CalculateRotation()
-            rotedit.text = int(self.rotation*180./np.pi)
+            def rotated():
+                rotedit.text = int(self.rotation*180./np.pi)
+            self.jobs.submit('Get PL Rotation', self.CalculateRotation, rotated)
         rot_button.on_clicked = rotclicked
         CalculatePLRotationRow.add(rot_button)
         CalculatePLRotationRow.add_spacing(6)
@@ -255,6 +479,7 @@ class GetDPCDelegate(object):
                 print('ValueError: Not Changing PL Rotation')
                 rotedit.text = round(self.rotation*180./np.pi,1)
             self.UpdateBFDisk()
+            refresh(['CoM X','Charge Density','E-Field Vectors','Potential'])
         rotedit.on_editing_finished = rot_editing_finished
         CalculatePLRotationRow.add(rotedit)
         CalculatePLRotationRow.add_spacing(8)
@@ -263,6 +488,7 @@ class GetDPCDelegate(object):
         DPC=ui.create_column_widget()
         DPC.add(SetRadiiRow)
         DPC.add(GetDIButtonRow)
+        DPC.add(GetBankRow)
         DPC.add(GetCOMShiftRow)
         DPC.add(CalculatePLRotationRow)
 
@@ -274,7 +500,7 @@ class GetDPCDelegate(object):
         GetRhoRow = ui.create_row_widget()
         getrho_button = ui.create_push_button_widget("Get Charge Density")
         def GetRho_clicked():
-            self.GetChargeDensity()
+            self.jobs.submit('Get Charge Density', self.GetChargeDensity, self.ShowChargeDensity)
         getrho_button.on_clicked = GetRho_clicked
         GetRhoRow.add(getrho_button)
 
@@ -282,7 +508,7 @@ class GetDPCDelegate(object):
         GetERow = ui.create_row_widget()
         gete_button = ui.create_push_button_widget("Get Electric Field")
         def GetE_clicked():
-            self.GetEFields()
+            self.jobs.submit('Get Electric Field', self.GetEFields, self.ShowEFields)
         gete_button.on_clicked = GetE_clicked
         GetERow.add(gete_button)
         
@@ -290,9 +516,17 @@ class GetDPCDelegate(object):
         GetPOTRow = ui.create_row_widget()
         getpot_button = ui.create_push_button_widget("Get Atomic Potential")
         def GetPOT_clicked():
-            self.GetPotential()
+            self.jobs.submit('Get Atomic Potential', self.GetPotential, self.ShowPotential)
         getpot_button.on_clicked = GetPOT_clicked
         GetPOTRow.add(getpot_button)
+
+        def refresh(names):
+            #Rotation and filter edits redo the results already shown from the stored CoM shifts, without reading the 4D-STEM Dataset
+            if self.dpcx is None: return
+            if 'CoM X' in names and self.Sink('CoM X').created: self.ShowCoM()
+            if 'Charge Density' in names and self.Sink('Charge Density').created: GetRho_clicked()
+            if 'E-Field Vectors' in names and self.Sink('E-Field Vectors').created: GetE_clicked()
+            if 'Potential' in names and self.Sink('Potential').created: GetPOT_clicked()
  
         ### Set High Pass Filtering 
         PotParamRow = ui.create_row_widget()
@@ -308,6 +542,7 @@ class GetDPCDelegate(object):
             except ValueError:
                 print('GotValueError: Did not change High Pass Filter')
                 hpedit.text = self.hpass
+            refresh(['Potential'])
         hpedit.on_editing_finished = hp_editing_finished
         PotParamRow.add(hpedit)
         PotParamRow.add_spacing(8)
@@ -324,8 +559,20 @@ class GetDPCDelegate(object):
             except ValueError:
                 print('GotValueError: Did not change High Pass Filter')
                 lpedit.text = self.lpass
+            refresh(['Potential'])
         lpedit.on_editing_finished = lp_editing_finished
         PotParamRow.add(lpedit)
+        PotParamRow.add_spacing(8)
+
+        ### Set Edge Handling of the Inverse Gradient
+        PotParamRow.add(ui.create_label_widget("Edges:"))
+        padcombo = ui.create_combo_box_widget(items=['none','mirror','zero'])
+        def pad_changed(pad):
+            if self.potpad!=pad: print('Set Edge Handling for Potential Reconstruction to '+str(pad))
+            self.potpad=pad
+            refresh(['Potential'])
+        padcombo.on_current_item_changed = pad_changed
+        PotParamRow.add(padcombo)
         
         ### Group and Display ###
         Electro=ui.create_column_widget()
@@ -345,6 +592,27 @@ class GetDPCDelegate(object):
         clear_button.on_clicked = CLEAR
         ClearRow.add(clear_button)
 
+        ### Progress of Background Calculations ###
+        StatusRow = ui.create_row_widget()
+        cancel_button = ui.create_push_button_widget("Cancel")
+        def CANCEL():
+            self.jobs.cancel()
+        cancel_button.on_clicked = CANCEL
+        StatusRow.add(cancel_button)
+        StatusRow.add_spacing(8)
+        statuslabel = ui.create_label_widget("Idle")
+        def status(text):
+            statuslabel.text = text
+        self.jobs.status = status
+        StatusRow.add(statuslabel)
+        StatusRow.add_stretch()
+        profile_checkbox = ui.create_check_box_widget("Profile")
+        def profile_changed(checked):
+            if self.jobs.instrument!=checked: print(('Started' if checked else 'Stopped')+' Profiling GetDPC Calculations')
+            self.jobs.instrument=checked
+        profile_checkbox.on_checked_changed = profile_changed
+        StatusRow.add(profile_checkbox)
+
         Menu = ui.create_column_widget()
         Menu.add(RonchigramCalibration) 
         Menu.add_spacing(24)
@@ -353,6 +621,7 @@ class GetDPCDelegate(object):
         Menu.add(Electro)
         Menu.add_spacing(8)
         Menu.add(ClearRow)
+        Menu.add(StatusRow)
         Menu.add_stretch()
         return Menu
 
@@ -366,146 +635,226 @@ class GetDPCDelegate(object):
         #Updates Annotation of circle around BF disk
         if self.dat4duuid==None: return
         dat4d=self.api.library.get_data_item_by_uuid(self.dat4duuid)
-        daty,datx=dat4d.data.shape[2:]
+        daty,datx=dat4d.data.shape[-2:]
         frcx=self.rcx/float(datx);frcy=self.rcy/float(daty);fr=self.conv*self.pixcal/float(datx)
         if len(dat4d.graphics)<1.:
             dat4d.add_ellipse_region(center_y=frcy,center_x=frcx,height=2*fr,width=2*fr)
         else: dat4d.graphics[0].bounds=((frcy-fr,frcx-fr),(2*fr,2*fr))
 
-    def CalibrateRonchigram(self):
-        dat4d=self.api.library.get_data_item_by_uuid(self.dat4duuid)
-        R, rcx, rcy, pixcal, BFdisk, absct, edge = GetDPC.CalibrateRonchigram(dat4d.data, self.conv, self.findct)
-        try:
-            NY, NX = R.shape[:2]
-        except ValueError:
-            print('ValueError: Select the 4D-STEM Dataset')
+    def Get4DData(self):
+        #Looked up on the UI thread, the panel computations then run on the job queue's worker thread
+        if self.dat4duuid==None: return None
+        return self.api.library.get_data_item_by_uuid(self.dat4duuid).data
+
+    def Get4DSource(self):
+        #Identifies the data of the selected data item, data rewritten in place gets a new modification time
+        if self.dat4duuid==None: return None
+        return (self.dat4duuid, self.api.library.get_data_item_by_uuid(self.dat4duuid).modified)
+
+    def Submit4D(self, name, compute, show):
+        #Runs compute(dat4d, progress, level, source) on the job queue, on the coarsest binned level while previewing
+        dat4d=self.Get4DData()
+        source=self.Get4DSource()
+        if self.preview and dat4d is not None and dat4d.ndim==5: print('Sequences are not previewed, processing at full resolution')
+        if not self.preview or (dat4d is not None and dat4d.ndim==5):
+            def job(progress=None):
+                try:
+                    compute(dat4d, progress=progress, source=source)
+                finally:
+                    self.pipeline.release('dat4d')
+            self.jobs.submit(name, job, show)
             return
+        def preview(progress=None):
+            try:
+                pyramid=self.GetPreviewPyramid(source, dat4d, progress)
+                compute(pyramid[pyramid.coarsest], progress=progress, level=pyramid.coarsest, source=source)
+            finally:
+                self.pipeline.release('dat4d')
+        self.jobs.submit(name+' (Preview)', preview, show)
+
+    def GetPreviewPyramid(self, source, dat4d, progress=None):
+        #Binned once per version of the 4D-STEM Dataset (uuid and modification time), every later preview reuses it
+        if dat4d is None or dat4d.ndim!=4: raise ValueError('Select the 4D-STEM Dataset')
+        if self.pyramid is None or self.pyramid[0]!=(source, dat4d.shape):
+            pyramid=GetDPC.GetPyramid(dat4d, self.previewlevels, progress=progress)
+            #Only the binned levels are kept, the full resolution data is released with the job like everywhere else
+            pyramid.levels[0]=None
+            self.pyramid=((source, dat4d.shape), pyramid)
+            print('Binned 4D-STEM Dataset for Previews to '+str(pyramid[pyramid.coarsest].shape))
+        return self.pyramid[1]
+
+    def Calibration(self, level=0):
+        #Ronchigram center and calibration for a level of the preview pyramid
+        if level==0: return self.rcx, self.rcy, self.pixcal
+        return self.pyramid[1].scale_calibration(level, self.rcx, self.rcy, self.pixcal)
+
+    def CalibrateRonchigram(self, dat4d, progress=None, level=0, source=None):
+        if dat4d is None or dat4d.ndim not in (4,5): raise ValueError('Select the 4D-STEM Dataset or a sequence of them')
+        #Sequences are calibrated once from their first frame, tracking follows the BF disk center from frame to frame
+        self.pipeline.set(dat4d=self.Keyed4D(dat4d, source, level), conv=self.conv, t=self.findct, track=256 if self.track and dat4d.ndim==5 else None)
+        result = self.pipeline.get('calibration', progress)
+        R, rcx, rcy, pixcal, BFdisk, absct, edge = result[:7]
+        self.drift = result[7]-result[7][0] if dat4d.ndim==5 and self.track else None
+        if level: rcx, rcy, pixcal = self.pyramid[1].unscale_calibration(level, rcx, rcy, pixcal)
         self.absct = absct
         self.rcx = rcx
         self.rcy = rcy
         self.pixcal=pixcal
+        self.centerfound = True
         print('Calibrated Ronchigrams. Sub-Pixel Center of BF Disk: X-'+str(round(self.rcx,2))+' Y-'+str(round(self.rcy,2))+'    Calibration: '+str(round(self.pixcal,2))+' pixels/mrad')
-        if len(dat4d.graphics)<1:
-            daty,datx=R.data.shape
-            frcx=self.rcx/float(datx);frcy=self.rcy/float(daty);fr=self.conv*self.pixcal/float(datx)
-            dat4d.add_ellipse_region(center_y=frcy,center_x=frcx,height=2*fr,width=2*fr)
-        else: self.UpdateBFDisk()
-
-    def CalculateRotation(self):
-        def DPC_ACD(DPCX,DPCY,tlow,thigh):        
-            A,C,D=[],[],[]
-            for t in np.linspace(tlow,thigh,10,endpoint=False):            
-                rDPCX,rDPCY=DPCX*np.cos(t)+DPCY*np.sin(t),-DPCX*np.sin(t)+DPCY*np.cos(t)        
-                gXY,gXX=np.gradient(rDPCX);gYY,gYX=np.gradient(rDPCY)        
-                C.append(np.std(gXY-gYX));D.append(np.std(gXX+gYY));A.append(t)
-            G=np.average([A[np.argmin(C)],A[np.argmax(D)]])
-            return G
-        DPCX,DPCY=self.dpcx,self.dpcy
-        G=DPC_ACD(DPCX,DPCY,0,np.pi)
-        for i in range(1,3): G=DPC_ACD(DPCX,DPCY,G-np.pi/(10**i),G+np.pi/(10**i))
-        self.rotation=GetDPC.GetPLRotation(self.dpcx,self.dpcy)
+
+    def ShowCalibration(self):
+        self.UpdateBFDisk()
+
+    def Keyed4D(self, dat4d, source, level=0):
+        #The pipeline compares the data by its source, so it neither keeps nor trusts the array between jobs
+        if source is None: return dat4d
+        return Pipeline.Keyed((source, level), dat4d)
+
+    def SetParameters(self, dat4d=None, level=0, source=None):
+        #Only the pipeline results depending on a changed parameter are computed again, the detector is only set with the data it applies to
+        if dat4d is not None:
+            RCX, RCY, RCal = self.Calibration(level)
+            centers = self.drift+(RCX, RCY) if dat4d.ndim==5 and self.drift is not None and len(self.drift)==len(dat4d) else None
+            self.pipeline.set(dat4d=self.Keyed4D(dat4d, source, level), RCX=RCX, RCY=RCY, RCal=RCal, RI=self.ri, RO=self.ro, centers=centers)
+        self.pipeline.set(rotation=self.rotation, hpass=self.hpass, lpass=self.lpass, pad=self.potpad)
+
+    def CalculateRotation(self, progress=None):
+        self.rotation=self.pipeline.get('auto_rotation', progress)
         print('Calculated PL Rotation Angle as '+str(round(self.rotation*180/np.pi,1))+' degrees`')
 
-    def GetICOM(self):
+    def GetICOM(self, dat4d, progress=None, level=0, source=None):
+        #The detector image comes from the same pass, so asking for it afterwards does not read the data again
+        self.SetParameters(dat4d, level, source)
+        self.dpcx, self.dpcy = self.pipeline.get('com', progress)
+        print('Calculated DPC from Center of Mass Shifts'+(' (Preview)' if level else ''))
+
+    def Sink(self, name):
+        if name not in self.sinks: self.sinks[name] = ResultSink(self.api)
+        return self.sinks[name]
+
+    def RotationTitle(self):
+        return ' (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)'
+
+    def ShowCoM(self):
+        #Rotated straight into the display buffers instead of into new arrays
+        c, s = np.cos(self.rotation), np.sin(self.rotation)
+        X = self.Sink('CoM X').buffer_like(self.dpcx.shape, self.dpcx.dtype)
+        Y = self.Sink('CoM Y').buffer_like(self.dpcy.shape, self.dpcy.dtype)
+        np.multiply(self.dpcy, -s, out=X)
+        X += c*self.dpcx
+        np.multiply(self.dpcx, s, out=Y)
+        Y += c*self.dpcy
+        self.Sink('CoM X').write(title='CoM Shifts X-Component'+self.RotationTitle())
+        self.Sink('CoM Y').write(title='CoM Shifts Y-Component'+self.RotationTitle())
+
+    def StartLiveCoM(self):
+        #Reduces scan rows of the selected 4D-STEM Dataset on a worker thread as they are written
+        if self.livethread is not None and self.livethread.is_alive(): return
+        self.livestop = threading.Event()
+        self.livethread = threading.Thread(target=self.LiveCoM, args=(self.livestop,), daemon=True)
+        self.livethread.start()
+        print('Started Live Center of Mass Shifts')
+
+    def StopLiveCoM(self):
+        if self.livestop is not None: self.livestop.set()
+
+    def LiveCoM(self, stop):
         dat4d=self.api.library.get_data_item_by_uuid(self.dat4duuid)
-        self.dpcx, self.dpcy = GetDPC.GetiCoM(dat4d.data, self.rcx, self.rcy, self.pixcal, self.ri, self.ro)
-        rdpcx=self.dpcx*np.cos(self.rotation)-self.dpcy*np.sin(self.rotation)
-        rdpcy=self.dpcx*np.sin(self.rotation)+self.dpcy*np.cos(self.rotation)
-        print('Calculated DPC from Center of Mass Shifts')
-        if not self.dpccalculated:
-            self.api.library.create_data_item_from_data(rdpcx)
-            self.dpcxuuid=self.api.library.data_items[-1].uuid
-            self.api.library.create_data_item_from_data(rdpcy)
-            self.dpcyuuid=self.api.library.data_items[-1].uuid
-            self.dpccalculated=True
-            DPCX = self.api.library.get_data_item_by_uuid(self.dpcxuuid)
-            DPCY = self.api.library.get_data_item_by_uuid(self.dpcyuuid)
-            DPCX.title=('CoM Shifts X-Component (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-            DPCY.title=('CoM Shifts Y-Component (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-        else:
-            DPCX = self.api.library.get_data_item_by_uuid(self.dpcxuuid)
-            DPCX.data=rdpcx
-            DPCY = self.api.library.get_data_item_by_uuid(self.dpcyuuid)
-            DPCY.data=rdpcy
-            DPCX.title=('CoM Shifts X-Component (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-            DPCY.title=('CoM Shifts Y-Component (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-
-    def GetEFields(self):
-        EMag, EDir, EDirLeg = GetDPC.GetElectricFields(self.dpcx, self.dpcy, rotation=self.rotation)
-       # self.EIM=EMag  
-       # CIMxd=xd.rgb(*np.transpose(EDir,(2,0,1)))
-       # CLEGxd=xd.rgb(*np.transpose(EDirLeg,(2,0,1)))
-        
-        if not self.fieldscalculated:
-            self.api.library.create_data_item()
-            self.EIMuuid=self.api.library.data_items[-1].uuid
-            self.api.library.create_data_item()
-            self.CIMuuid=self.api.library.data_items[-1].uuid
-            self.api.library.create_data_item()
-            self.CLEGuuid=self.api.library.data_items[-1].uuid
-            EIM=self.api.library.get_data_item_by_uuid(self.EIMuuid)
-            CIM=self.api.library.get_data_item_by_uuid(self.CIMuuid)
-            CLEG=self.api.library.get_data_item_by_uuid(self.CLEGuuid)
-            EIM.data=EMag
-            CIM.xdata=xd.rgb(*np.transpose(EDir,(2,0,1)))
-            CLEG.xdata=xd.rgb(*np.transpose(EDirLeg,(2,0,1)))
-            EIM.title=('E-Field Magnitude')
-            CIM.title=('E-Field Vectors (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-            CLEG.title=('E-Field Vectors Legend')
-            self.fieldscalculated=True
-        else:
-            EIM = self.api.library.get_data_item_by_uuid(self.EIMuuid)
-            CIM=self.api.library.get_data_item_by_uuid(self.CIMuuid)
-            CLEG=self.api.library.get_data_item_by_uuid(self.CLEGuuid)
-            EIM.data=EMag
-            CIM.xdata=xd.rgb(*np.transpose(EDir,(2,0,1)))
-            CLEG.xdata=xd.rgb(*np.transpose(EDirLeg,(2,0,1)))
-            EIM.title=('E-Field Magnitude')
-            CIM.title=('E-Field Vectors (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-            CLEG.title=('E-Field Vectors Legend')
-
-    def GetPotential(self):
-        self.VIM = GetDPC.GetPotential(self.dpcx, self.dpcy, rotation=self.rotation, hpass=self.hpass, lpass=self.lpass)
-        if not self.vimcalculated:
-            self.api.library.create_data_item_from_data(self.VIM)
-            self.VIMuuid=self.api.library.data_items[-1].uuid
-            VIM = self.api.library.get_data_item_by_uuid(self.VIMuuid)
-            VIM.title=('Atomic Potential: HPass='+str(self.hpass)+' LPass='+str(self.lpass))
-            self.vimcalculated=True
-        else:
-            VIM = self.api.library.get_data_item_by_uuid(self.VIMuuid)
-            VIM.title=('Atomic Potential: HPass='+str(self.hpass)+' LPass='+str(self.lpass))
-            VIM.data=self.VIM
-
-    def GetChargeDensity(self):
-        self.RHO=GetDPC.GetChargeDensity(self.dpcx, self.dpcy, rotation=self.rotation)
-        if not self.rhocalculated:
-            self.api.library.create_data_item_from_data(self.RHO)
-            self.RHOuuid=self.api.library.data_items[-1].uuid
-            RHO = self.api.library.get_data_item_by_uuid(self.RHOuuid)
-            RHO.title=('Charge Density (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-            self.rhocalculated=True
-        else:
-            RHO = self.api.library.get_data_item_by_uuid(self.RHOuuid)
-            RHO.title=('Charge Density (Rotation='+str(round(self.rotation*180/np.pi,1))+' degrees)')
-            RHO.data=self.RHO
-
-    def GetDetectorImage(self):
-        dat4d=self.api.library.get_data_item_by_uuid(self.dat4duuid).data
-        detim = GetDPC.GetDetectorImage(dat4d, self.rcx, self.rcy, self.pixcal, self.ri, self.ro)
-        if not self.detimgenerated:
-            self.api.library.create_data_item_from_data(detim)
-            self.detimuuid=self.api.library.data_items[-1].uuid
-            self.detimgenerated=True
-            DETim = self.api.library.get_data_item_by_uuid(self.detimuuid)
-            DETim.title=('Detector Image ('+str(int(self.ri))+'-'+str(int(self.ro))+' mrad)')
-        else:
-            DETim = self.api.library.get_data_item_by_uuid(self.detimuuid)
-            DETim.data=detim
-            DETim.title=('Detector Image ('+str(int(self.ri))+'-'+str(int(self.ro))+' mrad)')
+        acc=None
+        lastshown=0.
+        while not stop.is_set():
+            data=dat4d.data
+            if acc is None or acc.shape!=data.shape:
+                acc=GetDPC.IncrementalCoM(data.shape, self.rcx, self.rcy, self.pixcal, self.ri, self.ro)
+            newrows=acc.update(data)
+            if newrows and (acc.done or time.time()-lastshown>=self.liveinterval):
+                # Copies so the UI thread never sees rows that are half written, an update still waiting is replaced by the newer one
+                detector=acc.detector.copy()
+                update=functools.partial(self.PutLiveCoM, data, (self.dat4duuid, dat4d.modified), detector, acc.comx.copy(), acc.comy.copy())
+                self.jobs.submit('Live CoM', update, functools.partial(self.ShowLiveCoM, detector))
+                lastshown=time.time()
+            if acc.done: break
+            stop.wait(self.livepoll)
+        print('Stopped Live Center of Mass Shifts after '+str(acc.rows if acc is not None else 0)+' scan rows')
+
+    def PutLiveCoM(self, data, source, detector, comx, comy, progress=None):
+        #Runs on the job queue, so the dataset parameter never changes between another job's set and get
+        try:
+            self.SetParameters(data, source=source)
+            self.pipeline.put('detectors', (detector, comx, comy))
+        finally:
+            self.pipeline.release('dat4d')
+        self.dpcx, self.dpcy = comx, comy
+
+    def ShowLiveCoM(self, detector):
+        self.ShowCoM()
+        if self.Sink('Detector Image').created: self.ShowDetectorImage(detector)
+
+    def GetEFields(self, progress=None):
+        self.SetParameters()
+        self.EIM, self.CIM, self.CLEG = self.pipeline.get('fields', progress)
+
+    def ShowEFields(self):
+        #Swift keeps RGB images as uint8 in blue, green, red order, so the channels are reversed while copying
+        self.Sink('E-Field Magnitude').write(self.EIM, 'E-Field Magnitude')
+        self.Sink('E-Field Vectors').write(self.CIM[..., ::-1], 'E-Field Vectors'+self.RotationTitle())
+        self.Sink('E-Field Legend').write(self.CLEG[..., ::-1], 'E-Field Vectors Legend')
+
+    def GetPotential(self, progress=None):
+        #Forward transforms are kept until the CoM shifts, rotation or edge handling change, so filter changes only redo the inverse
+        self.SetParameters()
+        self.VIM = self.pipeline.get('potential', progress)
+
+    def ShowPotential(self):
+        self.Sink('Potential').write(self.VIM, 'Atomic Potential: HPass='+str(self.hpass)+' LPass='+str(self.lpass))
+
+    def GetChargeDensity(self, progress=None):
+        self.SetParameters()
+        self.RHO=self.pipeline.get('charge', progress)
+
+    def ShowChargeDensity(self):
+        self.Sink('Charge Density').write(self.RHO, 'Charge Density'+self.RotationTitle())
+
+    def GetDetectorImage(self, dat4d, progress=None, level=0, source=None):
+        self.SetParameters(dat4d, level, source)
+        self.DETIM = self.pipeline.get('detector', progress)
+
+    def ShowDetectorImage(self, detim):
+        self.Sink('Detector Image').write(detim, 'Detector Image ('+str(int(self.ri))+'-'+str(int(self.ro))+' mrad)')
+
+    def ParseDetectorBank(self, text):
+        #Comma separated standard detector names (BF, ABF, LAADF, HAADF, Q1-Q4, Quadrants) or Inner-Outer radii in mrad
+        standard=GetDPC.StandardDetectors(self.conv)
+        detectors={}
+        for token in [t.strip() for t in text.split(',') if t.strip()]:
+            if token.lower() in ('q','quadrants'):
+                for name in ['Q1','Q2','Q3','Q4']: detectors[name]=standard[name]
+            elif token.upper() in standard: detectors[token.upper()]=standard[token.upper()]
+            else:
+                ri,ro=[float(r) for r in token.split('-')]
+                detectors[token+' mrad']=(ri,ro)
+        if not detectors: raise ValueError('No detectors given')
+        return detectors
+
+    def GetDetectorBank(self, dat4d, progress=None, level=0, source=None):
+        detectors=self.ParseDetectorBank(self.banktext)
+        if dat4d is not None and dat4d.ndim==5:
+            self.SetParameters(dat4d, level, source)
+            stacks = GetDPC.GetSeriesDetectors(dat4d, *self.Calibration(level), list(detectors.values()), centers=self.pipeline.params['centers'], com=False, progress=progress)
+            self.BANK = dict(zip(detectors, stacks))
+        else: self.BANK = GetDPC.GetDetectorBank(dat4d, *self.Calibration(level), detectors, com=False, progress=progress)
+        print('Calculated '+str(len(self.BANK))+' Detector Images in One Pass')
+
+    def ShowDetectorBank(self):
+        for name, detim in self.BANK.items(): self.Sink('Bank '+name).write(detim, 'Detector Image ('+name+')')
+
+    def close(self):
+        self.StopLiveCoM()
+        if self.jobs is not None: self.jobs.close()
 
     def cleardpcuuid(self):
-        dat4duuid=None
-        self.dpccalculated=False
-        self.fieldscalculated=False
-        self.vimcalculated=False
+        #Later results go to new data items, the existing ones are left as they are, the selected 4D-STEM Dataset stays selected
+        self.sinks = {}
+        self.pyramid = None
+        self.pipeline.invalidate()
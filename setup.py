@@ -14,6 +14,8 @@ setuptools.setup(
     author="Jordan Hachtel",
     description="GetDPC package",
     packages=["getdpc", "nionswift_plugin.getdpc"],
-    install_requires=["matplotlib", "numpy", "scipy"],
+    install_requires=["numpy", "scipy"],
+    extras_require={"notebook": ["matplotlib"]},
     python_requires='~=3.6',
+    entry_points={'console_scripts': ['getdpc-batch=getdpc.Batch:main']},
 )